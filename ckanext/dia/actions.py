@@ -0,0 +1,218 @@
+# encoding: utf-8
+from ckan import model
+from ckan.common import _
+from ckan.logic import ValidationError
+from ckan.plugins import toolkit as tk
+
+from ckanext.dia.model import MintedURI
+from ckanext.dia.pagination import decode_cursor, encode_cursor
+
+# Default and largest number of results minted_uri_search returns
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 1000
+
+# Most URIs minted_uri_show looks up in one call
+MAX_SHOW_IDS = 1000
+
+
+def get_actions():
+    return {
+        'minted_uri_create': minted_uri_create,
+        'minted_uri_bulk_create': minted_uri_bulk_create,
+        'minted_uri_update': minted_uri_update,
+        'minted_uri_show': minted_uri_show,
+        'minted_uri_search': minted_uri_search,
+    }
+
+
+def minted_uri_dictize(minted_uri):
+    return dict(minted_uri.as_dict())
+
+
+def _user_id(context):
+    user_obj = context.get('auth_user_obj') or model.User.get(
+        context.get('user'))
+    if not user_obj:
+        raise tk.NotAuthorized(_('You must be logged in to mint URIs'))
+    return user_obj.id
+
+
+def minted_uri_create(context, data_dict):
+    '''
+    Mint a URI for an entity.
+
+    :param type: the type (namespace) of the entity
+    :type type: string
+    :param name: the name of the entity, unique within its type
+    :type name: string
+
+    :returns: the minted URI
+    :rtype: dictionary
+    '''
+    tk.check_access('minted_uri_create', context, data_dict)
+
+    minted_uri = MintedURI.create({
+        'type': data_dict.get('type'),
+        'name': data_dict.get('name'),
+        'created_by_id': _user_id(context),
+    })
+    return minted_uri_dictize(minted_uri)
+
+
+def minted_uri_bulk_create(context, data_dict):
+    '''
+    Mint a URI for each entity in a batch.
+
+    The batch is validated as a whole and either every URI is minted or,
+    if any entity is invalid, none are.
+
+    :param uris: the entities to mint URIs for, each a dictionary with a
+        ``type`` and a ``name``
+    :type uris: list of dictionaries
+
+    :returns: the minted URIs, in the order the entities were given
+    :rtype: list of dictionaries
+    '''
+    tk.check_access('minted_uri_bulk_create', context, data_dict)
+
+    uris = data_dict.get('uris')
+    if not isinstance(uris, list) or not uris:
+        raise ValidationError({'uris': [_('Missing value')]})
+
+    created_by_id = _user_id(context)
+    minted = MintedURI.bulk_create([
+        dict(uri, created_by_id=created_by_id)
+        if isinstance(uri, dict) else uri
+        for uri in uris])
+    return [minted_uri_dictize(minted_uri) for minted_uri in minted]
+
+
+def minted_uri_update(context, data_dict):
+    '''
+    Rename the entity a URI identifies, or regenerate its URI.
+
+    Only live URIs can be updated. Regenerating mints a new URI for the
+    entity and marks the given one as superseded by it.
+
+    :param id: the id of the URI
+    :type id: int
+    :param name: the new name of the entity
+    :type name: string
+    :param regenerate: mint a new URI for the entity (optional, default:
+        ``False``)
+    :type regenerate: bool
+
+    :returns: the updated URI, or the new one if it was regenerated
+    :rtype: dictionary
+    '''
+    tk.check_access('minted_uri_update', context, data_dict)
+
+    uri_id = _int_id(data_dict.get('id'))
+    minted_uri = MintedURI.get(uri_id) if uri_id is not None else None
+    if minted_uri is None:
+        raise tk.ObjectNotFound(_('URI not found'))
+    if minted_uri.superseded_by is not None:
+        raise ValidationError(
+            {'id': [_('URI is archived, editing not supported')]})
+
+    minted_uri = MintedURI.update(uri_id, {
+        'type': minted_uri.type,
+        'name': data_dict.get('name'),
+        'regenerate': tk.asbool(data_dict.get('regenerate', False)),
+        'updated_by_id': _user_id(context),
+    })
+    return minted_uri_dictize(minted_uri)
+
+
+@tk.side_effect_free
+def minted_uri_show(context, data_dict):
+    '''
+    Return one or more minted URIs, looked up by id or by URI.
+
+    :param id: the id or URI to look up, or a list of them to look up
+        together in one query
+    :type id: int, string or list
+
+    :returns: the URI, or for a list the URIs that were found in the order
+        they were asked for
+    :rtype: dictionary or list of dictionaries
+    '''
+    tk.check_access('minted_uri_show', context, data_dict)
+
+    requested = data_dict.get('id')
+    many = isinstance(requested, list)
+    keys = requested if many else [requested]
+    keys = [key for key in keys if key not in (None, '')]
+    if not keys:
+        raise ValidationError({'id': [_('Missing value')]})
+    if len(keys) > MAX_SHOW_IDS:
+        raise ValidationError({'id': [
+            _('At most {} URIs can be shown at once').format(MAX_SHOW_IDS)]})
+
+    ids = [_int_id(key) for key in keys]
+    found = MintedURI.get_many(
+        [uri_id for uri_id in ids if uri_id is not None],
+        [key for key, uri_id in zip(keys, ids) if uri_id is None])
+
+    by_key = {}
+    for minted_uri in found:
+        by_key[minted_uri.id] = by_key[minted_uri.uri] = minted_uri
+    results = [by_key[uri_id if uri_id is not None else key]
+               for key, uri_id in zip(keys, ids)
+               if (uri_id if uri_id is not None else key) in by_key]
+
+    if many:
+        return [minted_uri_dictize(minted_uri) for minted_uri in results]
+    if not results:
+        raise tk.ObjectNotFound(_('URI not found'))
+    return minted_uri_dictize(results[0])
+
+
+@tk.side_effect_free
+def minted_uri_search(context, data_dict):
+    '''
+    Search live URIs by name and type, newest first.
+
+    Results are paged with a cursor rather than an offset: pass the
+    ``next_cursor`` of one page as the ``cursor`` of the next.
+
+    :param q: text to look for in the name or type (optional)
+    :type q: string
+    :param limit: the most URIs to return (optional, default: 20, at most
+        1000)
+    :type limit: int
+    :param cursor: where the previous page ended (optional)
+    :type cursor: string
+
+    :returns: ``results``, the matching URIs, and ``next_cursor``, which is
+        None on the last page
+    :rtype: dictionary
+    '''
+    tk.check_access('minted_uri_search', context, data_dict)
+
+    try:
+        limit = int(data_dict.get('limit', SEARCH_LIMIT))
+    except (TypeError, ValueError):
+        raise ValidationError({'limit': [_('Invalid integer')]})
+    if not 0 < limit <= MAX_SEARCH_LIMIT:
+        raise ValidationError({'limit': [
+            _('Must be between 1 and {}').format(MAX_SEARCH_LIMIT)]})
+
+    cursor = data_dict.get('cursor')
+    after = decode_cursor(cursor)
+    if cursor and after is None:
+        raise ValidationError({'cursor': [_('Invalid cursor')]})
+
+    items, more = MintedURI.get_keyset_page(
+        {'q': data_dict.get('q', '')}, limit, after=after)
+    return {
+        'results': [minted_uri_dictize(minted_uri) for minted_uri in items],
+        'next_cursor': encode_cursor(items[-1]) if more else None,
+    }
+
+
+def _int_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,74 @@
+# encoding: utf-8
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    '''
+    A small thread safe mapping with least-recently-used eviction.
+
+    Entries expire `ttl` seconds after they were stored and the least recently
+    used entry is dropped once `maxsize` entries are held. Hits and misses are
+    counted so callers can report how effective the cache is.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=3600, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at <= self._timer():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self._timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self._timer()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -1,6 +1,6 @@
 # encoding: utf-8
 import click
-from ckanext.dia import utils, model
+from ckanext.dia import dump, export, utils, model
 
 
 def get_commands():
@@ -13,11 +13,46 @@ def dia():
 
 
 @dia.command()
-def cleanup_datastore():
+@click.option(u'--workers', default=1, type=click.IntRange(min=1),
+              help=u'Number of tables to delete concurrently')
+@click.option(u'--rate', default=100.0, type=click.FloatRange(min=0),
+              help=u'Maximum tables deleted per second, 0 for no limit')
+@click.option(u'--max-lock-waits', type=click.IntRange(min=0),
+              help=u'Back off while more than this many database sessions '
+                   u'are waiting on locks')
+@click.option(u'--state-file', type=click.Path(dir_okay=False),
+              help=u'Where to checkpoint progress')
+@click.option(u'--resume', is_flag=True,
+              help=u'Continue after the last checkpointed table')
+@click.option(u'--dry-run', is_flag=True,
+              help=u'Only report orphaned tables, do not delete them')
+@click.option(u'--max-tables', type=click.IntRange(min=1),
+              help=u'Stop after checking this many tables')
+@click.option(u'--json', u'output_json', is_flag=True,
+              help=u'Print a JSON summary as the last line of output')
+@click.option(u'--report', is_flag=True,
+              help=u'Report the orphaned tables by size instead of '
+                   u'deleting them')
+@click.option(u'--format', u'report_format', default=u'csv',
+              type=click.Choice([u'csv', u'json']),
+              help=u'Format of the --report output')
+@click.option(u'--output', type=click.Path(dir_okay=False, allow_dash=True),
+              help=u'File to write the --report to, defaults to stdout')
+def cleanup_datastore(workers, rate, max_lock_waits, state_file, resume,
+                      dry_run, max_tables, output_json, report,
+                      report_format, output):
     """
     Cleans datastore by deleting orphaned datastore resource tables
     """
-    return utils.cleanup_datastore()
+    if report:
+        utils.report_orphaned_datastore_tables(
+            output=output, output_format=report_format,
+            max_tables=max_tables)
+        return
+    return utils.cleanup_datastore(
+        workers=workers, rate=rate, max_lock_waits=max_lock_waits,
+        state_file=state_file, resume=resume, dry_run=dry_run,
+        max_tables=max_tables, output_json=output_json)
 
 @dia.command()
 def init_minted_uri_db():
@@ -25,3 +60,55 @@ def init_minted_uri_db():
     Create the db table for storing minted URIs
     """
     return model.db_setup()
+
+
+@dia.command()
+@click.argument(u'source', type=click.File(u'r'))
+@click.option(u'--format', u'input_format', type=click.Choice([u'csv', u'jsonl']),
+              help=u'Format of SOURCE, guessed from its extension if not set')
+@click.option(u'--batch-size', default=500, type=click.IntRange(min=1),
+              help=u'Number of URIs minted in each transaction')
+@click.option(u'--user',
+              help=u'Name of the user minting the URIs, defaults to the '
+                   u'site user')
+def mint_uris(source, input_format, batch_size, user):
+    """
+    Mint URIs in bulk from a CSV or JSON lines file of types and names
+    """
+    return utils.mint_uris(
+        source, input_format=input_format, batch_size=batch_size, user=user)
+
+
+@dia.command()
+@click.option(u'--format', u'output_format', default=u'csv',
+              type=click.Choice(sorted(export.EXPORT_FORMATS)),
+              help=u'Format to export the URIs in')
+@click.option(u'--output', default=u'-',
+              type=click.File(u'w', encoding=u'utf-8', lazy=True),
+              help=u'File to write the export to, defaults to stdout')
+@click.option(u'--batch-size', default=export.EXPORT_BATCH_SIZE,
+              type=click.IntRange(min=1),
+              help=u'Number of URIs fetched from the database at a time')
+def export_uris(output_format, output, batch_size):
+    """
+    Export every minted URI, superseded ones included
+    """
+    return export.export_uris(
+        output, output_format=output_format, batch_size=batch_size)
+
+
+@dia.command()
+@click.option(u'--path', type=click.Path(dir_okay=False),
+              help=u'Where to write the dump, defaults to '
+                   u'ckanext.dia.uri_dump_path')
+@click.option(u'--full', is_flag=True,
+              help=u'Rebuild the whole dump instead of merging in changes')
+def build_uri_dump(path, full):
+    """
+    Publish the minted URIs as an N-Triples dump
+    """
+    path = path or dump.get_dump_path()
+    if not path:
+        raise click.UsageError(
+            u'Set ckanext.dia.uri_dump_path or pass --path')
+    dump.build_uri_dump(path, full=full)
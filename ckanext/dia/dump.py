@@ -0,0 +1,153 @@
+# encoding: utf-8
+from __future__ import print_function
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+from sqlalchemy import func
+from sqlalchemy.sql.expression import or_
+
+from ckan.common import config
+from ckanext.dia.export import iter_register, uri_triples
+from ckanext.dia.model import MintedURI
+
+# Rows changed this long before the previous build started are rendered
+# again, to cover transactions that were still open and clock drift between
+# the application servers that set the timestamps
+REBUILD_MARGIN = datetime.timedelta(minutes=5)
+
+
+def get_dump_path():
+    return config.get('ckanext.dia.uri_dump_path') or None
+
+
+def _meta_path(path):
+    return path + '.meta.json'
+
+
+def read_dump_meta(path):
+    '''
+    The sidecar metadata of the dump at `path`: when it was built, its ETag
+    and the number of URIs in it. None if the dump has not been built.
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(_meta_path(path)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_atomic(path, write):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.')
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            result = write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return result
+
+
+def _iter_dump_entries(path):
+    '''
+    Yields `(uri, lines)` for each URI in an existing dump, which holds the
+    triples of each URI on consecutive lines.
+    '''
+    with io.open(path, encoding='utf-8') as f:
+        for uri, lines in itertools.groupby(
+                f, key=lambda line: line[1:line.index('>')]):
+            yield uri, u''.join(lines)
+
+
+def _merge_entries(path, changed):
+    '''
+    Yields the text of the updated dump: the entries of the dump at `path`,
+    with the URIs in `changed` rendered afresh and new ones slotted in.
+    '''
+    keys = sorted(changed)
+    position = 0
+    for uri, text in _iter_dump_entries(path):
+        while position < len(keys) and keys[position] < uri:
+            yield keys[position], uri_triples(changed[keys[position]])
+            position += 1
+        if position < len(keys) and keys[position] == uri:
+            yield uri, uri_triples(changed[uri])
+            position += 1
+        else:
+            yield uri, text
+    for uri in keys[position:]:
+        yield uri, uri_triples(changed[uri])
+
+
+def build_uri_dump(path=None, full=False):
+    '''
+    Writes the minted URI register as N-Triples, which is also valid Turtle,
+    to `path` (default `ckanext.dia.uri_dump_path`).
+
+    The entries are kept sorted by URI, so once the dump has been built
+    only the URIs minted or changed since the previous build are read from
+    the database and merged in, the rest of the dump is copied as it is.
+    Pass `full` to rebuild it from scratch. The build time and ETag are kept
+    in a `.meta.json` file next to the dump.
+
+    Superseded URIs link to their successor with `dct:isReplacedBy`, and
+    are deliberately not declared `owl:sameAs` it. A URI is only regenerated
+    when the entity's remit has changed, so the two do not identify the
+    same thing, and sameAs would merge their statements in any reasoner.
+    '''
+    path = path or get_dump_path()
+    if not path:
+        raise ValueError('ckanext.dia.uri_dump_path is not set')
+
+    built_at = datetime.datetime.utcnow()
+    meta = None if full else read_dump_meta(path)
+    if meta is not None:
+        since = datetime.datetime.strptime(
+            meta['built_at'], '%Y-%m-%dT%H:%M:%S.%f') - REBUILD_MARGIN
+        changed = dict((row['uri'], row) for row in iter_register(
+            query_filter=or_(MintedURI.created_at >= since,
+                             MintedURI.updated_at >= since)))
+        print('{} URIs changed since {}'.format(
+            len(changed), meta['built_at']), file=sys.stderr)
+        if not changed:
+            meta = dict(meta, built_at=built_at.strftime(
+                '%Y-%m-%dT%H:%M:%S.%f'))
+            _write_atomic(_meta_path(path), lambda f: f.write(
+                json.dumps(meta, indent=2) + u'\n'))
+            return meta
+        entries = _merge_entries(path, changed)
+    else:
+        print('Building the URI dump from scratch', file=sys.stderr)
+        # Sorting the UTF-8 bytes matches Python's string ordering, which
+        # the merge relies on, whatever the database collation
+        entries = ((row['uri'], uri_triples(row)) for row in iter_register(
+            order_by=func.convert_to(MintedURI.uri, 'UTF8')))
+
+    def write(f):
+        digest = hashlib.sha1()
+        count = 0
+        for uri, text in entries:
+            f.write(text)
+            digest.update(text.encode('utf-8'))
+            count += 1
+        return {
+            'built_at': built_at.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'etag': digest.hexdigest(),
+            'count': count,
+        }
+
+    meta = _write_atomic(path, write)
+    _write_atomic(_meta_path(path), lambda f: f.write(
+        json.dumps(meta, indent=2) + u'\n'))
+    print('Wrote {} URIs to {}'.format(meta['count'], path), file=sys.stderr)
+    return meta
@@ -0,0 +1,142 @@
+# encoding: utf-8
+import csv
+import io
+import json
+
+from sqlalchemy.orm import aliased
+
+from ckanext.dia.model import MintedURI
+
+# Content type and file extension of each export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'nt': ('application/n-triples', 'nt'),
+}
+
+EXPORT_FIELDS = ['id', 'uri', 'type', 'name', 'created_at', 'updated_at',
+                 'superseded_by', 'superseded_by_uri']
+
+# Rows fetched from the server-side cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+DCT_TYPE = 'http://purl.org/dc/terms/type'
+DCT_CREATED = 'http://purl.org/dc/terms/created'
+DCT_MODIFIED = 'http://purl.org/dc/terms/modified'
+DCT_IS_REPLACED_BY = 'http://purl.org/dc/terms/isReplacedBy'
+XSD_DATETIME = 'http://www.w3.org/2001/XMLSchema#dateTime'
+
+
+def iter_register(batch_size=EXPORT_BATCH_SIZE, query_filter=None,
+                  order_by=None):
+    '''
+    Yields every minted URI, superseded ones included, as a dict of
+    `EXPORT_FIELDS` in id order.
+
+    The URI that superseded each one is joined in, so a chain can be
+    followed without a lookup per row. Rows are streamed from a server-side
+    cursor `batch_size` at a time, so memory use does not grow with the
+    register. `query_filter` may narrow the query further and `order_by`
+    replace the id ordering.
+    '''
+    successor = aliased(MintedURI)
+    query = MintedURI.Session.query(
+        MintedURI.id, MintedURI.uri, MintedURI.type, MintedURI.name,
+        MintedURI.created_at, MintedURI.updated_at, MintedURI.superseded_by,
+        successor.uri.label('superseded_by_uri'))\
+        .outerjoin(successor, successor.id == MintedURI.superseded_by)\
+        .order_by(order_by if order_by is not None else MintedURI.id)
+    if query_filter is not None:
+        query = query.filter(query_filter)
+    for row in query.yield_per(batch_size):
+        yield dict(zip(EXPORT_FIELDS, row))
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def iter_csv(rows, batch_size=EXPORT_BATCH_SIZE):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([
+            _isoformat(row[field]) if field in ('created_at', 'updated_at')
+            else row[field]
+            for field in EXPORT_FIELDS])
+        if count % batch_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        row = dict(row, created_at=_isoformat(row['created_at']),
+                   updated_at=_isoformat(row['updated_at']))
+        yield json.dumps(row) + '\n'
+
+
+def _nt_literal(value, datatype=None):
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+    if datatype:
+        return u'"{}"^^<{}>'.format(escaped, datatype)
+    return u'"{}"'.format(escaped)
+
+
+def uri_triples(row):
+    '''
+    The N-Triples statements describing one minted URI, as a string.
+
+    The entity's name is its `rdfs:label`, and a superseded URI points at
+    its successor with `dct:isReplacedBy`.
+    '''
+    subject = u'<{}>'.format(row['uri'])
+    triples = [
+        (RDFS_LABEL, _nt_literal(row['name'] or u'')),
+        (DCT_TYPE, _nt_literal(row['type'] or u'')),
+    ]
+    if row['created_at'] is not None:
+        triples.append((DCT_CREATED, _nt_literal(
+            row['created_at'].isoformat(), XSD_DATETIME)))
+    if row['updated_at'] is not None:
+        triples.append((DCT_MODIFIED, _nt_literal(
+            row['updated_at'].isoformat(), XSD_DATETIME)))
+    if row['superseded_by_uri']:
+        triples.append((DCT_IS_REPLACED_BY,
+                        u'<{}>'.format(row['superseded_by_uri'])))
+    return u''.join(
+        u'{} <{}> {} .\n'.format(subject, predicate, obj)
+        for predicate, obj in triples)
+
+
+def iter_ntriples(rows):
+    for row in rows:
+        yield uri_triples(row)
+
+
+def iter_export(output_format, batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Yields the whole register as chunks of text in `output_format`, one of
+    `EXPORT_FORMATS`.
+    '''
+    rows = iter_register(batch_size=batch_size)
+    if output_format == 'csv':
+        return iter_csv(rows, batch_size=batch_size)
+    if output_format == 'jsonl':
+        return iter_jsonl(rows)
+    if output_format == 'nt':
+        return iter_ntriples(rows)
+    raise ValueError('Unknown export format {}'.format(output_format))
+
+
+def export_uris(output, output_format='csv', batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Writes the whole register to `output`, a writable file object.
+    '''
+    for chunk in iter_export(output_format, batch_size=batch_size):
+        output.write(chunk)
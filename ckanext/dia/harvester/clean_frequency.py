@@ -1,11 +1,16 @@
+import re
+from collections import Counter
+from functools import lru_cache
 from logging import getLogger
+
+from ckanext.dia.cache import TTLCache
+
 log = getLogger(__name__)
 
 iso_8601_frequency = {
     "R/P1Y": "Annual",
     "R/P2Y": "Biennial",
     "R/P2M": "Bimonthly",
-    "R/P2M": "Bimonthly",
     "R/P0.5W": "Biweekly",
     "R/P2W": "Biweekly",
     "R/PT1S": "Continuously updated",
@@ -51,33 +56,146 @@ csw_non_iso_8601_to_iso_8601_frequency = {
 }
 
 
-def clean_frequency(frequency):
+SECONDS_PER_DAY = 24 * 60 * 60
+
+DURATION_PATTERN = re.compile(
+    r'^(?:r\d*/)?p'
+    r'(?:(?P<years>\d+(?:\.\d+)?)y)?'
+    r'(?:(?P<months>\d+(?:\.\d+)?)m)?'
+    r'(?:(?P<weeks>\d+(?:\.\d+)?)w)?'
+    r'(?:(?P<days>\d+(?:\.\d+)?)d)?'
+    r'(?:t(?:(?P<hours>\d+(?:\.\d+)?)h)?'
+    r'(?:(?P<minutes>\d+(?:\.\d+)?)m)?'
+    r'(?:(?P<seconds>\d+(?:\.\d+)?)s)?)?$')
+
+# Distinct unmapped frequencies counted per harvest job, any more are only
+# counted in total under OTHER_UNMAPPED
+MAX_UNMAPPED_FREQUENCIES = 100
+OTHER_UNMAPPED = '(other)'
+
+# Counters of unmapped frequencies keyed by harvest job id
+_unmapped_frequencies = TTLCache(maxsize=8, ttl=86400)
+
+
+def _normalize(frequency):
+    return ' '.join(str(frequency).split()).casefold()
+
+
+def parse_duration(frequency):
+    """
+    Parses an ISO 8601 duration or repeating interval, such as `P1Y` or
+    `R/P12M`, into `('months', n)` or `('seconds', n)` so that equivalent
+    durations compare equal.
+
+    Returns None if the frequency is not a duration, or if it mixes
+    calendar and clock units (e.g. `P1M2D`), whose length is ambiguous.
+    """
+    match = DURATION_PATTERN.match(_normalize(frequency))
+    if not match or not any(match.groupdict().values()):
+        return None
+    parts = dict((unit, float(value))
+                 for unit, value in match.groupdict().items() if value)
+    months = parts.get('years', 0) * 12 + parts.get('months', 0)
+    seconds = (
+        (parts.get('weeks', 0) * 7 + parts.get('days', 0)) * SECONDS_PER_DAY
+        + parts.get('hours', 0) * 3600 + parts.get('minutes', 0) * 60
+        + parts.get('seconds', 0))
+    if months and seconds:
+        return None
+    if months:
+        return ('months', round(months, 6))
+    return ('seconds', round(seconds, 6))
+
+
+def _build_indexes():
+    """
+    Builds the lookups used by clean_frequency: normalised names and terms
+    to their English frequency, and parsed durations to their frequency.
+
+    Durations shared by more than one frequency (`R/P0.5W` and `R/P3.5D`)
+    are left out of the duration index, those terms only match exactly.
+    """
+    names = {}
+    for frequency in iso_8601_frequency.values():
+        names.setdefault(_normalize(frequency), frequency)
+    for table in (iso_8601_frequency, non_iso_8601_to_iso_8601_frequency,
+                  csw_non_iso_8601_to_iso_8601_frequency):
+        for term, frequency in table.items():
+            names.setdefault(_normalize(term), frequency)
+
+    durations = {}
+    for term, frequency in iso_8601_frequency.items():
+        durations.setdefault(parse_duration(term), set()).add(frequency)
+    durations = dict(
+        (duration, frequencies.pop())
+        for duration, frequencies in durations.items()
+        if duration is not None and len(frequencies) == 1)
+    return names, durations
+
+
+frequency_index, duration_index = _build_indexes()
+
+
+@lru_cache(maxsize=1024)
+def lookup_frequency(frequency):
+    """
+    The English ISO 8601 frequency for `frequency`, ignoring case and
+    whitespace and matching equivalent durations, or None if it is unknown.
+    """
+    normalized = _normalize(frequency)
+    if normalized in frequency_index:
+        return frequency_index[normalized]
+    return duration_index.get(parse_duration(normalized))
+
+
+def get_unmapped_frequencies(harvest_job_id=None):
+    """
+    How many times each unmapped frequency was harvested in the job, for
+    reporting. Values beyond the first `MAX_UNMAPPED_FREQUENCIES` are
+    counted together under `OTHER_UNMAPPED`.
+    """
+    return Counter(_unmapped_frequencies.get(harvest_job_id) or {})
+
+
+def _count_unmapped(frequency, harvest_job_id):
+    counter = _unmapped_frequencies.get(harvest_job_id)
+    if counter is None:
+        counter = Counter()
+        _unmapped_frequencies.set(harvest_job_id, counter)
+    if frequency not in counter and \
+            len(counter) >= MAX_UNMAPPED_FREQUENCIES:
+        if not counter[OTHER_UNMAPPED]:
+            log.warning(
+                "More than {0} unknown frequencies in harvest job {1}, "
+                "no longer logging them".format(
+                    MAX_UNMAPPED_FREQUENCIES, harvest_job_id))
+        counter[OTHER_UNMAPPED] += 1
+        return None
+    counter[frequency] += 1
+    return counter[frequency]
+
+
+def clean_frequency(frequency, harvest_job_id=None):
     """
     Frequency (accrualPeriodicity) must match the ISO 8601 term.
 
     In the database the frequency stored should the the ISO-8601 English
     equvivalent. The following cleaning is done:
     - If the frequency is already the English equivalent it is returned.
-    - ISO-8601 terms are mapped to the English equivalent.
+    - ISO-8601 terms and equivalent durations are mapped to the English
+      equivalent.
     - Some other obvious mappings are also mapped to the ISO-8601 terms.
-    - All other things are set to Irregular and and logged.
+    - All other things are set to Irregular, counted per harvest job (see
+      `get_unmapped_frequencies`) and logged the first time they are seen
+      in the job.
     """
-    log.debug("_clean_frequency: {0}".format(frequency))
-    if frequency in list(iso_8601_frequency.values()):
-        return frequency
-    if frequency in iso_8601_frequency:
-        return iso_8601_frequency[frequency]
-    if frequency in non_iso_8601_to_iso_8601_frequency:
-        log.info(
-            "Harvested frequency of {0} mapped to {1}:"
-            .format(frequency, non_iso_8601_to_iso_8601_frequency[frequency])
+    mapped = lookup_frequency(frequency)
+    if mapped is not None:
+        return mapped
+
+    if _count_unmapped(frequency, harvest_job_id) == 1:
+        log.warning(
+            "frequency_of_update found in harvest job {0} is an unknown "
+            "value: {1}".format(harvest_job_id, frequency)
         )
-        return non_iso_8601_to_iso_8601_frequency[frequency]
-    if frequency.lower() in csw_non_iso_8601_to_iso_8601_frequency:
-        return csw_non_iso_8601_to_iso_8601_frequency[frequency.lower()]
-
-    log.warning(
-        "frequency_of_update found in dcat harvesting is an unknown value: {0}"
-        .format(frequency)
-    )
     return 'Irregular'
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+import threading
+from logging import getLogger
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ckan.plugins as p
+import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckanext.dcat.interfaces import IDCATRDFHarvester
+from ckanext.dia.cache import TTLCache
+
+log = getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Last good response for each URL that sent an ETag or Last-Modified header
+_validated_responses = None
+
+
+def get_session():
+    '''
+    Returns the pooled session shared by all outbound harvester requests.
+
+    Connections are kept alive per host, at most
+    `ckanext.dia.http.pool_maxsize` of them, and failed requests are retried
+    with an exponential backoff. Like ckanext-dcat, the session is passed
+    through every `IDCATRDFHarvester.update_session` so plugins can add
+    headers or authentication.
+    '''
+    global _session, _validated_responses
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=tk.asint(config.get('ckanext.dia.http.retries', 3)),
+                backoff_factor=float(
+                    config.get('ckanext.dia.http.backoff_factor', 0.5)),
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=tk.asint(
+                    config.get('ckanext.dia.http.pool_connections', 10)),
+                pool_maxsize=tk.asint(
+                    config.get('ckanext.dia.http.pool_maxsize', 4)),
+                max_retries=retry,
+                pool_block=True)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                session = harvester.update_session(session)
+
+            _validated_responses = TTLCache(
+                maxsize=tk.asint(
+                    config.get('ckanext.dia.http.conditional_cache_size', 256)),
+                ttl=tk.asint(
+                    config.get('ckanext.dia.http.conditional_cache_ttl',
+                               86400)))
+            _session = session
+    return _session
+
+
+def get_timeout():
+    return (
+        float(config.get('ckanext.dia.http.connect_timeout', 5)),
+        float(config.get('ckanext.dia.http.read_timeout', 30)),
+    )
+
+
+def get(url, **kwargs):
+    '''
+    GET `url` through the shared session with the configured timeouts.
+
+    If a previous response for the URL carried an ETag or Last-Modified
+    header the request is made conditional, and that response is returned
+    again when the server answers 304 Not Modified.
+    '''
+    session = get_session()
+    kwargs.setdefault('timeout', get_timeout())
+    headers = dict(kwargs.pop('headers', None) or {})
+
+    previous = _validated_responses.get(url)
+    if previous is not None:
+        if previous.headers.get('ETag'):
+            headers['If-None-Match'] = previous.headers['ETag']
+        if previous.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = previous.headers['Last-Modified']
+
+    resp = session.get(url, headers=headers, **kwargs)
+
+    if resp.status_code == 304 and previous is not None:
+        log.debug("{} not modified, reusing previous response".format(url))
+        _validated_responses.set(url, previous)
+        return previous
+    if resp.ok and (resp.headers.get('ETag') or
+                    resp.headers.get('Last-Modified')):
+        _validated_responses.set(url, resp)
+    return resp
@@ -4,6 +4,8 @@ import pycountry
 import re
 from logging import getLogger
 
+from lxml import etree
+
 from ckan import model
 from ckan import plugins as p
 from ckantoolkit import config
@@ -11,24 +13,76 @@ from ckanext.spatial.interfaces import ISpatialHarvester
 from ckanext.spatial.harvested_metadata import MappedXmlDocument, ISOElement, ISODataFormat
 from ckan.logic.action.get import license_list
 from ckanext.dia.converters import strip_invalid_tags_content
-from pyproj import Proj, transform
 from .clean_frequency import clean_frequency
+from .groups import get_default_groups
+from .source_config import get_source_config
+from .reproject import get_transformer, reproject_geojson
 from ckan.plugins import toolkit as tk, implements, SingletonPlugin
 
 log = getLogger(__name__)
 
+# Built from the license register on first use, see _get_license_matcher
+_license_matcher = None
+
+
+class CompiledXPathMixin(object):
+    '''
+    Evaluates search paths with lxml XPath objects that are compiled once
+    per process, instead of compiling each expression again for every
+    harvested record.
+
+    All ISO elements share the same namespaces so the compiled paths are
+    shared between them, keyed by the path alone.
+    '''
+
+    _compiled_paths = {}
+
+    @classmethod
+    def compile_search_paths(cls, elements):
+        for element in elements:
+            for xpath in element.get_search_paths():
+                element.get_compiled_path(xpath)
+            cls.compile_search_paths(element.elements)
+
+    def get_compiled_path(self, xpath):
+        try:
+            return self._compiled_paths[xpath]
+        except KeyError:
+            compiled = etree.XPath(xpath, namespaces=self.namespaces)
+            self._compiled_paths[xpath] = compiled
+            return compiled
+
+    def get_elements(self, tree, xpath):
+        return self.get_compiled_path(xpath)(tree)
+
 
-class DIAISOResponsibleParty(ISOElement):
+class DIAISOElement(CompiledXPathMixin, ISOElement):
+    pass
+
+
+class DIADataFormat(CompiledXPathMixin, ISODataFormat):
 
     elements = [
-        ISOElement(
+        DIAISOElement(
+            name=element.name,
+            search_paths=element.search_paths,
+            multiplicity=element.multiplicity,
+        )
+        for element in ISODataFormat.elements
+    ]
+
+
+class DIAISOResponsibleParty(CompiledXPathMixin, ISOElement):
+
+    elements = [
+        DIAISOElement(
             name="contact-info",
             search_paths=[
                 "gmd:contactInfo/gmd:CI_Contact",
             ],
             multiplicity="0..1",
             elements=[
-                ISOElement(
+                DIAISOElement(
                     name="phone",
                     search_paths=[
                         ("gmd:phone/gmd:CI_Telephone/gmd:voice/"
@@ -41,17 +95,17 @@ class DIAISOResponsibleParty(ISOElement):
     ]
 
 
-class DIARights(ISOElement):
+class DIARights(CompiledXPathMixin, ISOElement):
 
     elements = [
-        ISOElement(
+        DIAISOElement(
             name="use_limitation",
             search_paths=[
                 "gmd:useLimitation/gco:CharacterString/text()"
             ],
             multiplicity="0..1"
         ),
-        ISOElement(
+        DIAISOElement(
             name="use_constraints",
             search_paths=[
                 "gmd:useConstraints/gmd:MD_RestrictionCode/text()"
@@ -61,9 +115,9 @@ class DIARights(ISOElement):
     ]
 
 
-class ISOCornerPoints(ISOElement):
+class ISOCornerPoints(CompiledXPathMixin, ISOElement):
     elements = [
-        ISOElement(
+        DIAISOElement(
             name="pos",
             search_paths=[
                 "gml:Point/gml:pos/text()"
@@ -76,7 +130,7 @@ class ISOCornerPoints(ISOElement):
 class DIADocument(MappedXmlDocument):
 
     elements = [
-        ISOElement(
+        DIAISOElement(
             name="language",
             search_paths=[
                 ("gmd:identificationInfo/gmd:MD_DataIdentification/"
@@ -94,7 +148,7 @@ class DIADocument(MappedXmlDocument):
             ],
             multiplicity="0..1",
         ),
-        ISOElement(
+        DIAISOElement(
             name="jurisdiction",
             search_paths=[
                 ("gmd:identificationInfo/gmd:MD_DataIdentification/gmd:extent/"
@@ -122,7 +176,7 @@ class DIADocument(MappedXmlDocument):
             ],
             multiplicity="*"
         ),
-        ISODataFormat(
+        DIADataFormat(
             name="data-format",
             search_paths=[
                 ("gmd:distributionInfo/gmd:MD_Distribution/"
@@ -143,6 +197,10 @@ class DIADocument(MappedXmlDocument):
     ]
 
 
+# Compile every search path up front rather than on the first record
+CompiledXPathMixin.compile_search_paths(DIADocument.elements)
+
+
 class DIASpatialHarvester(SingletonPlugin):
     implements(ISpatialHarvester, inherit=True)
 
@@ -194,8 +252,10 @@ class DIASpatialHarvester(SingletonPlugin):
         package_dict = data_dict['package_dict']
         iso_values = data_dict['iso_values']
 
+        # Reuse the tree ckanext-spatial already parsed for iso_values
         dia_values = DIADocument(
-            data_dict['harvest_object'].content
+            xml_str=data_dict['harvest_object'].content,
+            xml_tree=data_dict.get('xml_tree')
         ).read_values()
 
         if 'language' in dia_values:
@@ -280,46 +340,36 @@ class DIASpatialHarvester(SingletonPlugin):
 
         frequency = _get_object_extra(package_dict, 'frequency-of-update')
         if frequency:
-            package_dict['frequency_of_update'] = clean_frequency(frequency)
+            package_dict['frequency_of_update'] = clean_frequency(
+                frequency, data_dict['harvest_object'].harvest_job_id)
 
         log.debug("CSW iso_values: {}".format(iso_values))
         log.debug("CSW package_dict: {}".format(package_dict))
         log.debug("CSW custom mappings: {}".format(dia_values))
 
         # Adding default tags and groups from the source config
-        try:
-            conf = json.loads(data_dict['harvest_object'].source.config)
-        except ValueError:
-            # Failed to decode a JSON object
-            log.info("Failed to decode source config, using defaults")
-            conf = {}
+        conf = get_source_config(data_dict['harvest_object'].source)
 
         tags = package_dict.get('tags', [])
         tags = strip_invalid_tags_content(tags)
-        tags.extend(conf.get('default_tags', []))
+        tags.extend(dict(tag) for tag in conf.default_tags)
         package_dict['tags'] = list(dict((tag['name'], tag)
                                     for tag in tags).values())
 
         # Adding default_groups from config. This was previously not supported
         # by ckanext-spatial.
         context = {'model': model, 'user': self._get_user_name()}
-        groups = []
-        for group_name_or_id in conf.get('default_groups', []):
-            try:
-                group = tk.get_action('group_show')(
-                    context, {'id': group_name_or_id})
-                groups.append({'id': group['id'], 'name': group['name']})
-            except tk.ObjectNotFound:
-                log.error(
-                    'Default group %s not found, proceeding without.'
-                    % group_name_or_id)
-                pass
+        groups = get_default_groups(
+            context, conf.default_groups,
+            data_dict['harvest_object'].harvest_job_id)
 
         package_dict['groups'] = list(
             dict((group['id'], group) for group in groups).values())
 
         # CSW records can have a non wgs-84 projection, we will need to
         # convert the geojson to wgs-84
+        spatial_srid = None
+        spatial_geojson = None
         for extra in package_dict['extras']:
             if extra['key'] == 'spatial-reference-system':
                 spatial_srid = extra['value']
@@ -336,12 +386,8 @@ class DIASpatialHarvester(SingletonPlugin):
         # so we throw an error and leave it as-is
         cornerPoints = dia_values.get('corner-points')
         if spatial_srid and spatial_geojson is not None:
-            inProj = None
-            try:
-                inProj = Proj('+init=EPSG:' + spatial_srid)
-            except RuntimeError:
-                # When the SRID is unknown, don't convert
-                pass
+            # When the SRID is unknown, don't convert
+            transformer = get_transformer(spatial_srid)
 
             if cornerPoints:
                 log.warn(
@@ -349,45 +395,13 @@ class DIASpatialHarvester(SingletonPlugin):
                      "Will not convert Geometry. cornerPoints:"
                      " {} spatial_geojson: {} SRID: EPSG:{}")
                     .format(cornerPoints, spatial_geojson, spatial_srid))
-            elif inProj:
-
-                outProj = Proj('+init=EPSG:4326')
-
-                if spatial_geojson['type'] == 'MultiPolygon':
-                    new_polygons = []
-                    for polygon in spatial_geojson['coordinates']:
-                        new_linestrings = []
-                        for linestring in polygon:
-                            new_linestring = []
-                            for x, y in linestring:
-                                nx, ny = transform(inProj, outProj, x, y)
-                                new_linestring.append([nx, ny])
-                            new_linestrings.append(new_linestring)
-                        new_polygons.append(new_linestrings)
-                    spatial_geojson['coordinates'] = new_polygons
-
-                elif spatial_geojson['type'] == 'Polygon':
-                    new_linestrings = []
-                    for linestring in spatial_geojson['coordinates']:
-                        new_linestring = []
-                        for x, y in linestring:
-                            nx, ny = transform(inProj, outProj, x, y)
-                            new_linestring.append([nx, ny])
-                        new_linestrings.append(new_linestring)
-                    spatial_geojson['coordinates'] = new_linestrings
-
-                elif spatial_geojson['type'] == 'Point':
-                    # {
-                    #   "type": "Point",
-                    #   "coordinates": [2145000.0, 5467000.0]
-                    # }
-                    x, y = spatial_geojson['coordinates']
-                    nx, ny = transform(inProj, outProj, x, y)
-                    spatial_geojson['coordinates'] = [nx, ny]
-                else:
-                    msg = ("The DIA CSW harvest does not understand how to"
-                           "re-project a {} type of geojson")
-                    log.warn(msg.format(spatial_geojson['spatial']))
+            elif transformer:
+                try:
+                    spatial_geojson = reproject_geojson(
+                        spatial_geojson, transformer)
+                except ValueError as e:
+                    log.warn('{} for package {}'.format(
+                        e, package_dict.get('name')))
 
             # create updated version of extras array with correct
             # SRID + spatial field
@@ -428,28 +442,72 @@ def _filter_rights(dia_values):
 
 
 def _get_license(dia_values):
-    licenses = license_list({'model': model}, {})
-    url_to_id = {}
-    for license in licenses:
-        url_to_id[license['url']] = license['id']
-
-    url_regex_to_id = {}
-    for url, id in list(url_to_id.items()):
-        # all urls are https and end with a trailing slash
-        # what we are matching might not be
-        escaped_url = re.escape(url.replace('https', '').strip('/'))
-        url_regex = '(http|https){}/*'.format(escaped_url)
-        url_regex_to_id[url_regex] = id
-
+    matcher = _get_license_matcher()
     candidates = [x for x in dia_values['rights']
                   if x['use_constraints'] == 'license']
     for candidate in candidates:
-        for url in url_regex_to_id:
-            if re.search(url, candidate['use_limitation']):
-                return url_regex_to_id[url]
+        license_id = matcher.match(candidate['use_limitation'])
+        if license_id:
+            return license_id
     return 'other'
 
 
+def _get_license_matcher():
+    '''
+    Returns the license matcher for the current license register.
+
+    The matcher is built once per process and only rebuilt when CKAN loads a
+    new license register.
+    '''
+    global _license_matcher
+    register = model.Package.get_license_register()
+    if _license_matcher is None or _license_matcher.register is not register:
+        _license_matcher = LicenseMatcher(
+            license_list({'model': model}, {}), register)
+    return _license_matcher
+
+
+class LicenseMatcher(object):
+    '''
+    Finds the first known license URL mentioned in a block of text.
+
+    All license URLs are compiled into a single alternation so each
+    candidate is scanned once, whatever the number of licenses. When more
+    than one license is mentioned the one listed first in the register wins.
+    '''
+
+    def __init__(self, licenses, register=None):
+        self.register = register
+        # all urls are https and end with a trailing slash
+        # what we are matching might not be
+        url_to_id = {}
+        for license in licenses:
+            if license['url']:
+                url_to_id[_normalize_license_url(license['url'])] = \
+                    license['id']
+
+        self._index = {}
+        for position, (url, id) in enumerate(url_to_id.items()):
+            self._index[url] = (position, id)
+
+        self._pattern = None
+        if url_to_id:
+            self._pattern = re.compile('(?:http|https)({})/*'.format(
+                '|'.join(re.escape(url) for url in url_to_id)))
+
+    def match(self, text):
+        if self._pattern is None or not text:
+            return None
+        found = [self._index[m.group(1)] for m in self._pattern.finditer(text)]
+        if found:
+            return min(found)[1]
+        return None
+
+
+def _normalize_license_url(url):
+    return re.sub(r'^https?', '', url).strip('/')
+
+
 def _filter_format(format_str):
     return format_str[2:] if format_str.startswith("*.") else format_str
 
@@ -5,6 +5,8 @@ from string import Template
 import json
 import traceback
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 
 import requests
@@ -12,14 +14,32 @@ import requests
 from ckan import model
 import ckan.plugins as p
 import ckan.plugins.toolkit as tk
+from ckan.common import config
 from ckan.logic.action.get import license_list
 from ckanext.dcat.harvesters import DCATJSONHarvester
 from ckanext.dcat.interfaces import IDCATRDFHarvester
 from ckanext.dia.converters import strip_invalid_tags_content
+from ckanext.dia.harvester import client
 from ckanext.dia.harvester.clean_frequency import clean_frequency
+from ckanext.dia.harvester.source_config import (
+    SourceConfig, get_source_config
+)
+from ckanext.dia.harvester.groups import (
+    get_default_groups, get_existing_groups
+)
+from ckanext.dia.cache import TTLCache
 
 log = getLogger(__name__)
 
+# Resolved license URLs, shared by every harvest object in this process
+_license_cache = None
+
+# The gather stage stores the license id of successfully resolved license
+# URLs under this key in the harvest object content, so the import stage does
+# not have to fetch them again. Failures are not stored, so the import stage
+# retries them.
+PREFETCHED_LICENSE_KEY = 'dia:license'
+
 
 class DIADCATJSONHarvester(DCATJSONHarvester):
     p.implements(IDCATRDFHarvester, inherit=True)
@@ -39,6 +59,12 @@ class DIADCATJSONHarvester(DCATJSONHarvester):
         }
     ''')
 
+    # IHarvester
+    def validate_config(self, source_config):
+        # None of the DCAT base classes define validate_config
+        SourceConfig.parse(source_config)
+        return source_config
+
     # IDCATRDFHarvester
     def update_session(self, session):
         session.headers.update({'X-Harvest': 'data.govt.nz/dcat-json'})
@@ -88,58 +114,51 @@ class DIADCATJSONHarvester(DCATJSONHarvester):
         CC url is the harvested license link
     '''
 
-    def _fetch_license_id(self, license_url, harvest_object):
+    def _fetch_license_id(self, license_url, harvest_object, prefetched=None):
         # if a license is not provided we need to return this as
         # other ie. copyright
         if license_url == "":
             return "other"
 
-        licenses = license_list({'model': model}, {})
-        try:
-            resp = requests.get(license_url)
-        except (requests.exceptions.InvalidSchema,
-                requests.exceptions.InvalidURL,
-                requests.exceptions.MissingSchema):
-            self._save_object_error(
-                f'License URL is invalid.',
-                harvest_object)
-            return None
-        except Exception as e:
-            log.exception("Failed to fetch license.")
-            self._save_object_error(
-                f"Fetching license at '{license_url}' failed: {e}",
-                harvest_object)
-            return None
-        # dealing with direct CC url don't call for a json response
-        try:
-            if urlparse(license_url).netloc == 'creativecommons.org':
-                for license in licenses:
-                    if (urlparse(license['url'])._replace(scheme='http') ==
-                       urlparse(resp.url)._replace(scheme='http') and resp.status_code == 200):
-                        log.debug("Using license {}".format(license['id']))
-                        return license['id']
-        except Exception:
-            log.exception("Not a direct CC license URL")
+        cache = _get_license_cache()
+        if prefetched is not None:
+            # resolved during the gather stage, see _prefetch_licenses
+            resolved = (prefetched, None)
+        else:
+            resolved = cache.get(license_url)
+        if resolved is None:
+            licenses = license_list({'model': model}, {})
+            resolved = _resolve_license(license_url, licenses)
+            cache.set(license_url, resolved)
+            log.info("License cache miss for {}: {}".format(
+                license_url, cache.stats()))
+        else:
+            log.debug("License cache hit for {}: {}".format(
+                license_url, cache.stats()))
 
-        # not a CC url, call out for json response and
-        # check for known variations
-        try:
-            license_data = resp.json()
-            for license in licenses:
-                can_use_license = (
-                    license['title'] in license_data.get('title', '') or
-                    license['title'] in license_data.get('description', '') or
-                    license['url'] in license_data.get('description', '') or
-                    license['url'] == license_data.get('link', '')
-                )
-                if can_use_license:
-                    log.debug("Using license {}".format(license['id']))
-                    return license['id']
-        except Exception:
-            self._save_object_error(
-                f'Failed to parse license, response not JSON. URL: {license_url}',
-                harvest_object)
-            return None
+        license_id, error = resolved
+        if error:
+            self._save_object_error(error, harvest_object)
+        return license_id
+
+    def _get_guids_and_datasets(self, content):
+        guids_and_datasets = list(super(
+            DIADCATJSONHarvester, self)._get_guids_and_datasets(content))
+
+        datasets = [json.loads(as_string)
+                    for guid, as_string in guids_and_datasets]
+        resolved = _prefetch_licenses(
+            [dataset.get('license') for dataset in datasets])
+
+        for (guid, as_string), dataset in zip(guids_and_datasets, datasets):
+            license_url = dataset.get('license')
+            license_id, error = (None, None)
+            if isinstance(license_url, six.string_types):
+                license_id, error = resolved.get(license_url, (None, None))
+            if license_id is not None and error is None:
+                dataset[PREFETCHED_LICENSE_KEY] = license_id
+                as_string = json.dumps(dataset)
+            yield guid, as_string
 
     def _get_package_dict(self, harvest_object):
         package_dict, dcat_dict = super(
@@ -156,12 +175,15 @@ class DIADCATJSONHarvester(DCATJSONHarvester):
             'theme': lambda x: x['theme'],
             'rights': lambda x: x['rights'],  # Not tested
             'frequency_of_update': lambda x:
-                clean_frequency(x['accrualPeriodicity']),
+                clean_frequency(x['accrualPeriodicity'],
+                                harvest_object.harvest_job_id),
             'language': lambda x: x['language'],
             'source_identifier': lambda x: x['identifier'],
             'license_url': lambda x: x['license'],
             'license_id':
-                lambda x: self._fetch_license_id(x['license'], harvest_object),
+                lambda x: self._fetch_license_id(
+                    x['license'], harvest_object,
+                    x.get(PREFETCHED_LICENSE_KEY)),
             'temporal': lambda x: x['temporal']
         }
 
@@ -194,42 +216,24 @@ class DIADCATJSONHarvester(DCATJSONHarvester):
         return package_dict, dcat_dict
 
     def modify_package_dict(self, package_dict, dcat_dict, harvest_object):
-        try:
-            conf = json.loads(harvest_object.source.config)
-        except ValueError:
-            # Failed to decode a JSON object
-            log.info("Failed to decode source config, using defaults")
-            conf = {}
+        conf = get_source_config(harvest_object.source)
 
         tags = package_dict.get('tags', [])
         tags = strip_invalid_tags_content(tags)
-        tags.extend(conf.get('default_tags', []))
+        tags.extend(dict(tag) for tag in conf.default_tags)
         package_dict['tags'] = list(dict((tag['name'], tag)
                                     for tag in tags).values())
 
         context = {'model': model, 'user': self._get_user_name()}
-        groups = []
 
         # DATA-519: Get existing groups from the package
         # before appending default groups
-        try:
-            query = {'id': package_dict.get('name', None)}
-            original_package = tk.get_action(
-                'package_show')(context, query)
-            groups = original_package['groups']
-        except tk.ObjectNotFound:
-            pass
-
-        for group_name_or_id in conf.get('default_groups', []):
-            try:
-                group = tk.get_action('group_show')(
-                    context, {'id': group_name_or_id})
-                groups.append({'id': group['id'], 'name': group['name']})
-            except tk.ObjectNotFound:
-                log.error(
-                    'Default group %s not found, proceeding without.'
-                    % group_name_or_id)
-                pass
+        groups = get_existing_groups(
+            package_dict.get('name', None), harvest_object)
+
+        groups.extend(get_default_groups(
+            context, conf.default_groups,
+            harvest_object.harvest_job_id))
 
         package_dict['groups'] = list(
             dict((group['name'], group) for group in groups).values())
@@ -242,3 +246,126 @@ class DIADCATJSONHarvester(DCATJSONHarvester):
             package_dict['theme'] = json.dumps(package_dict.get('theme'))
 
         return package_dict
+
+
+def _get_license_cache():
+    '''
+    Returns the process wide cache of resolved license URLs, creating it on
+    first use so that the size and TTL can be read from the CKAN config.
+    '''
+    global _license_cache
+    if _license_cache is None:
+        _license_cache = TTLCache(
+            maxsize=tk.asint(
+                config.get('ckanext.dia.license_cache.size', 256)),
+            ttl=tk.asint(
+                config.get('ckanext.dia.license_cache.ttl', 3600)))
+    return _license_cache
+
+
+def _prefetch_licenses(license_urls):
+    '''
+    Resolves every distinct license URL in `license_urls` concurrently.
+
+    Lookups run on a bounded thread pool with a limit on the number of
+    concurrent requests made to any one host. Anything that has not been
+    resolved once the timeout is reached is left for the import stage.
+
+    Returns a dict mapping each resolved URL to its `(license_id, error)`.
+    '''
+    cache = _get_license_cache()
+    resolved = {}
+    pending = []
+    for license_url in set(url for url in license_urls
+                           if url and isinstance(url, six.string_types)):
+        cached = cache.get(license_url)
+        if cached is None:
+            pending.append(license_url)
+        else:
+            resolved[license_url] = cached
+
+    if not pending:
+        return resolved
+
+    licenses = license_list({'model': model}, {})
+    per_host = tk.asint(config.get('ckanext.dia.license_prefetch.per_host', 2))
+    host_limits = dict(
+        (host, threading.BoundedSemaphore(per_host))
+        for host in set(urlparse(url).netloc for url in pending))
+
+    def resolve(license_url):
+        with host_limits[urlparse(license_url).netloc]:
+            result = _resolve_license(license_url, licenses)
+        cache.set(license_url, result)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=tk.asint(
+        config.get('ckanext.dia.license_prefetch.workers', 8)))
+    futures = dict(
+        (executor.submit(resolve, license_url), license_url)
+        for license_url in pending)
+    done, not_done = wait(futures, timeout=tk.asint(
+        config.get('ckanext.dia.license_prefetch.timeout', 60)))
+    # shutdown does not drop queued lookups, so cancel them rather than
+    # leaving them to run after gather has finished
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+    for future in done:
+        try:
+            resolved[futures[future]] = future.result()
+        except Exception:
+            log.exception(
+                "Failed to prefetch license {}".format(futures[future]))
+    log.info("Prefetched {} of {} license URLs, {} timed out: {}".format(
+        len(done), len(pending), len(not_done), cache.stats()))
+
+    return resolved
+
+
+def _resolve_license(license_url, licenses):
+    '''
+    Resolves a harvested license URL against the known `licenses`.
+
+    Returns a `(license_id, error)` tuple so that both successful lookups and
+    failures can be cached and replayed for every dataset using the URL.
+    '''
+    try:
+        resp = client.get(license_url)
+    except (requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidURL,
+            requests.exceptions.MissingSchema):
+        return None, 'License URL is invalid.'
+    except Exception as e:
+        log.exception("Failed to fetch license.")
+        return None, f"Fetching license at '{license_url}' failed: {e}"
+    # dealing with direct CC url don't call for a json response
+    try:
+        if urlparse(license_url).netloc == 'creativecommons.org':
+            for license in licenses:
+                if (urlparse(license['url'])._replace(scheme='http') ==
+                   urlparse(resp.url)._replace(scheme='http') and resp.status_code == 200):
+                    log.debug("Using license {}".format(license['id']))
+                    return license['id'], None
+    except Exception:
+        log.exception("Not a direct CC license URL")
+
+    # not a CC url, call out for json response and
+    # check for known variations
+    try:
+        license_data = resp.json()
+        for license in licenses:
+            can_use_license = (
+                license['title'] in license_data.get('title', '') or
+                license['title'] in license_data.get('description', '') or
+                license['url'] in license_data.get('description', '') or
+                license['url'] == license_data.get('link', '')
+            )
+            if can_use_license:
+                log.debug("Using license {}".format(license['id']))
+                return license['id'], None
+    except Exception:
+        return None, (
+            f'Failed to parse license, response not JSON. URL: {license_url}')
+    return None, None
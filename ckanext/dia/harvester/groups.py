@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from logging import getLogger
+
+from ckan import model
+import ckan.plugins.toolkit as tk
+from ckan.common import config
+from ckanext.harvest.model import HarvestObject
+from ckanext.dia.cache import TTLCache
+
+log = getLogger(__name__)
+
+_missing = object()
+
+# Resolved default groups keyed by (harvest job id, group name or id)
+_default_group_cache = None
+
+# Group memberships of a source's packages keyed by harvest job id
+_existing_groups_cache = None
+
+
+def _get_default_group_cache():
+    global _default_group_cache
+    if _default_group_cache is None:
+        _default_group_cache = TTLCache(
+            maxsize=tk.asint(
+                config.get('ckanext.dia.group_cache.size', 1024)),
+            ttl=tk.asint(config.get('ckanext.dia.group_cache.ttl', 3600)))
+    return _default_group_cache
+
+
+def get_default_groups(context, group_names_or_ids, harvest_job_id):
+    '''
+    Returns `{'id': ..., 'name': ...}` dicts for the source's default groups.
+
+    Each group is looked up with `group_show` once per harvest job, every
+    other record in the job reuses the cached result. Groups that can not
+    be found are left out.
+    '''
+    cache = _get_default_group_cache()
+    groups = []
+    for group_name_or_id in group_names_or_ids:
+        key = (harvest_job_id, group_name_or_id)
+        group = cache.get(key, _missing)
+        if group is _missing:
+            try:
+                group_dict = tk.get_action('group_show')(
+                    dict(context), {
+                        'id': group_name_or_id,
+                        'include_datasets': False,
+                        'include_dataset_count': False,
+                        'include_extras': False,
+                        'include_users': False,
+                        'include_groups': False,
+                        'include_tags': False,
+                        'include_followers': False,
+                    })
+                group = {'id': group_dict['id'], 'name': group_dict['name']}
+            except tk.ObjectNotFound:
+                log.error(
+                    'Default group %s not found, proceeding without.'
+                    % group_name_or_id)
+                group = None
+            cache.set(key, group)
+        if group is not None:
+            groups.append(dict(group))
+    return groups
+
+
+def _get_existing_groups_cache():
+    global _existing_groups_cache
+    if _existing_groups_cache is None:
+        _existing_groups_cache = TTLCache(
+            maxsize=tk.asint(
+                config.get('ckanext.dia.group_cache.size', 1024)),
+            ttl=tk.asint(config.get('ckanext.dia.group_cache.ttl', 3600)))
+    return _existing_groups_cache
+
+
+def get_existing_groups(package_name, harvest_object):
+    '''
+    Returns `{'id': ..., 'name': ...}` dicts for the groups the package
+    called `package_name` currently belongs to.
+
+    The memberships of every package harvested from the source are loaded
+    with a single query the first time this is called in a harvest job.
+    '''
+    if not package_name:
+        return []
+    cache = _get_existing_groups_cache()
+    job_id = harvest_object.harvest_job_id
+    memberships = cache.get(job_id)
+    if memberships is None:
+        memberships = _load_source_package_groups(
+            harvest_object.harvest_source_id)
+        cache.set(job_id, memberships)
+    return [dict(group) for group in memberships.get(package_name, [])]
+
+
+def _load_source_package_groups(harvest_source_id):
+    '''
+    Maps the name of each package harvested from the source to its groups,
+    using the same membership rules as `package_show`.
+    '''
+    query = model.Session.query(
+        model.Package.name, model.Group.id, model.Group.name)\
+        .join(HarvestObject, HarvestObject.package_id == model.Package.id)\
+        .join(model.Member, model.Member.table_id == model.Package.id)\
+        .join(model.Group, model.Group.id == model.Member.group_id)\
+        .filter(HarvestObject.harvest_source_id == harvest_source_id)\
+        .filter(HarvestObject.current == True)\
+        .filter(model.Member.table_name == 'package')\
+        .filter(model.Member.state == 'active')\
+        .filter(model.Group.is_organization == False)
+
+    memberships = {}
+    for package_name, group_id, group_name in query:
+        groups = memberships.setdefault(package_name, [])
+        if not any(group['id'] == group_id for group in groups):
+            groups.append({'id': group_id, 'name': group_name})
+    return memberships
@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+from logging import getLogger
+
+from pyproj import Transformer
+from pyproj.exceptions import CRSError
+
+log = getLogger(__name__)
+
+# Nesting depth of the coordinate arrays for each GeoJSON geometry type
+COORDINATE_DEPTH = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3,
+}
+
+# One transformer per source SRID, None when the SRID is unknown
+_transformers = {}
+
+
+def get_transformer(srid):
+    '''
+    Returns a cached transformer from EPSG:`srid` to WGS-84 longitude and
+    latitude, or None if PROJ does not know the SRID.
+    '''
+    srid = str(srid).strip()
+    try:
+        return _transformers[srid]
+    except KeyError:
+        pass
+    try:
+        transformer = Transformer.from_crs(
+            'EPSG:' + srid, 'EPSG:4326', always_xy=True)
+    except (CRSError, RuntimeError):
+        log.info('Unknown SRID EPSG:{}, geometries will not be converted'
+                 .format(srid))
+        transformer = None
+    _transformers[srid] = transformer
+    return transformer
+
+
+def reproject_geojson(geojson, transformer):
+    '''
+    Returns a copy of the `geojson` geometry with every position converted
+    by `transformer`.
+
+    All positions, including those of a GeometryCollection's members, are
+    collected into two flat sequences and converted in a single call.
+    Raises ValueError for geometry types that are not understood.
+    '''
+    xs = []
+    ys = []
+    _collect(geojson, xs, ys)
+    nxs, nys = transformer.transform(xs, ys)
+    return _rebuild(geojson, iter(zip(nxs, nys)))
+
+
+def _collect(geometry, xs, ys):
+    geometry_type = geometry.get('type')
+    if geometry_type == 'GeometryCollection':
+        for member in geometry['geometries']:
+            _collect(member, xs, ys)
+    elif geometry_type in COORDINATE_DEPTH:
+        _collect_positions(
+            geometry['coordinates'], COORDINATE_DEPTH[geometry_type], xs, ys)
+    else:
+        raise ValueError(
+            'Can not re-project a {} type of geojson'.format(geometry_type))
+
+
+def _collect_positions(coordinates, depth, xs, ys):
+    if depth == 0:
+        xs.append(coordinates[0])
+        ys.append(coordinates[1])
+    else:
+        for child in coordinates:
+            _collect_positions(child, depth - 1, xs, ys)
+
+
+def _rebuild(geometry, positions):
+    geometry = dict(geometry)
+    if geometry['type'] == 'GeometryCollection':
+        geometry['geometries'] = [
+            _rebuild(member, positions) for member in geometry['geometries']]
+    else:
+        geometry['coordinates'] = _rebuild_positions(
+            geometry['coordinates'], COORDINATE_DEPTH[geometry['type']],
+            positions)
+    return geometry
+
+
+def _rebuild_positions(coordinates, depth, positions):
+    if depth == 0:
+        # keep any elevation or measure values as they are
+        return list(next(positions)) + list(coordinates[2:])
+    return [_rebuild_positions(child, depth - 1, positions)
+            for child in coordinates]
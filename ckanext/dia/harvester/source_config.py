@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+import hashlib
+import json
+from logging import getLogger
+
+import six
+
+from ckanext.dia.cache import TTLCache
+
+log = getLogger(__name__)
+
+# Parsed configs keyed by (harvest source id, hash of the config string)
+_source_configs = TTLCache(maxsize=64, ttl=86400)
+
+
+class SourceConfig(object):
+    '''
+    The options DIA harvesters read from a harvest source's JSON config.
+
+    `default_tags` is a list of tag dicts and `default_groups` a list of
+    group names or ids.
+    '''
+
+    def __init__(self, default_tags=None, default_groups=None):
+        self.default_tags = default_tags or []
+        self.default_groups = default_groups or []
+
+    @classmethod
+    def parse(cls, config_str):
+        '''
+        Parses and validates a source config string.
+
+        Tags may be given as names or as dicts with a `name`. Raises
+        ValueError when the config is not valid.
+        '''
+        if not config_str:
+            return cls()
+        conf = json.loads(config_str)
+        if not isinstance(conf, dict):
+            raise ValueError('Source config must be a JSON object')
+
+        default_tags = conf.get('default_tags', [])
+        if not isinstance(default_tags, list):
+            raise ValueError('default_tags must be a list')
+        tags = []
+        for tag in default_tags:
+            if isinstance(tag, six.string_types):
+                tag = {'name': tag}
+            if not isinstance(tag, dict) or not tag.get('name'):
+                raise ValueError(
+                    'default_tags must be a list of tag names or '
+                    'dictionaries with a name')
+            tags.append(tag)
+
+        default_groups = conf.get('default_groups', [])
+        if not isinstance(default_groups, list) or not all(
+                isinstance(group, six.string_types)
+                for group in default_groups):
+            raise ValueError(
+                'default_groups must be a list of group names or ids')
+
+        return cls(default_tags=tags, default_groups=default_groups)
+
+
+def get_source_config(harvest_source):
+    '''
+    Returns the parsed SourceConfig for `harvest_source`.
+
+    The config is parsed once and cached until the source's config changes.
+    An invalid config is logged once and replaced by the defaults.
+    '''
+    config_str = harvest_source.config or ''
+    key = (harvest_source.id,
+           hashlib.sha1(config_str.encode('utf-8')).hexdigest())
+    source_config = _source_configs.get(key)
+    if source_config is None:
+        try:
+            source_config = SourceConfig.parse(config_str)
+        except ValueError as e:
+            log.warning(
+                "Invalid config for harvest source {}, using defaults: {}"
+                .format(harvest_source.id, e))
+            source_config = SourceConfig()
+        _source_configs.set(key, source_config)
+    return source_config
@@ -4,9 +4,15 @@ from __future__ import print_function
 import datetime
 import logging
 import sys
+import time
 import six
-from sqlalchemy import Table, Column, types, ForeignKey, desc, func
-from sqlalchemy.sql.expression import or_
+from sqlalchemy import (
+    Table, Column, types, ForeignKey, desc, func, text, tuple_
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.expression import or_, select, union
 from urllib.parse import urljoin, quote
 from os import path
 import uuid
@@ -20,10 +26,22 @@ from ckan.logic.converters import remove_whitespace
 from ckan.model import DomainObject
 from ckan.model.meta import metadata, mapper
 from ckan.common import _, config
+from ckanext.dia.cache import TTLCache
 
 
 log = logging.getLogger(__name__)
 minted_uri_table = None
+# Whether pg_trgm is enabled, see trigram_search_available
+_trigram_search = None
+# Whether the indexes in REQUIRED_INDEXES have been found, see
+# minted_uri_indexes_available
+_required_indexes_confirmed = False
+# Recently resolved URIs, see MintedURI.resolve
+_resolved_uri_cache = None
+# Register version the cached resolutions were made at, and when it was last
+# read from the database, see _check_resolved_uri_cache
+_resolved_uri_version = None
+_resolved_uri_version_checked_at = None
 
 
 def db_setup():
@@ -42,6 +60,140 @@ def db_setup():
     else:
         print("Minted URI table already exists -- skipping creation")
 
+    failed = create_indexes()
+    create_search_indexes()
+    if failed:
+        log.critical("Could not create the minted_uri indexes %s",
+                     ', '.join(failed))
+        sys.exit(1)
+
+
+# Unique indexes that enforce the uniqueness rules when minting
+REQUIRED_INDEXES = ('minted_uri_uri_idx', 'minted_uri_type_name_idx')
+
+# Indexes backing the uniqueness rules and the listing order. Existing
+# installs get them the next time db_setup is run.
+MINTED_URI_INDEXES = [
+    ('minted_uri_uri_idx',
+     'CREATE UNIQUE INDEX IF NOT EXISTS minted_uri_uri_idx '
+     'ON minted_uri (uri)'),
+    ('minted_uri_type_name_idx',
+     'CREATE UNIQUE INDEX IF NOT EXISTS minted_uri_type_name_idx '
+     'ON minted_uri (lower(type), lower(name)) '
+     'WHERE superseded_by IS NULL'),
+    ('minted_uri_created_at_idx',
+     'CREATE INDEX IF NOT EXISTS minted_uri_created_at_idx '
+     'ON minted_uri (created_at, id)'),
+    ('minted_uri_superseded_by_idx',
+     'CREATE INDEX IF NOT EXISTS minted_uri_superseded_by_idx '
+     'ON minted_uri (superseded_by) WHERE superseded_by IS NOT NULL'),
+    ('minted_uri_updated_at_idx',
+     'CREATE INDEX IF NOT EXISTS minted_uri_updated_at_idx '
+     'ON minted_uri (updated_at)'),
+]
+
+
+def create_indexes():
+    '''
+    Add the indexes on the minted_uri table if they are missing.
+
+    The unique indexes can not be created while the table holds
+    duplicates, those are listed so they can be fixed before running the
+    migration again. Returns the names of the indexes that could not be
+    created.
+    '''
+    failed = []
+    for name, statement in MINTED_URI_INDEXES:
+        try:
+            with model.meta.engine.begin() as connection:
+                connection.execute(statement)
+            print("Created index {} (if it did not exist)".format(name))
+        except IntegrityError:
+            print("Could not create unique index {} -- the minted_uri table "
+                  "contains duplicates:".format(name))
+            for duplicate in _find_duplicates(name):
+                print("  {}".format(duplicate))
+            failed.append(name)
+    return failed
+
+
+def missing_minted_uri_indexes():
+    '''
+    The names of the unique indexes minting relies on that are missing or
+    not valid, for example because `dia init-minted-uri-db` has not been
+    run since upgrading.
+    '''
+    with model.meta.engine.connect() as connection:
+        present = set(name for (name,) in connection.execute(
+            text(
+                "SELECT c.relname FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = ANY(:names) AND i.indisvalid"),
+            names=list(REQUIRED_INDEXES)))
+    return [name for name in REQUIRED_INDEXES if name not in present]
+
+
+def minted_uri_indexes_available():
+    '''
+    Whether the unique indexes minting relies on exist. Checked on every
+    mint until they are found, then once per process.
+    '''
+    global _required_indexes_confirmed
+    if not _required_indexes_confirmed:
+        _required_indexes_confirmed = not missing_minted_uri_indexes()
+    return _required_indexes_confirmed
+
+
+def _find_duplicates(index_name):
+    if index_name == 'minted_uri_uri_idx':
+        query = MintedURI.Session.query(MintedURI.uri, func.count())\
+            .group_by(MintedURI.uri)
+    else:
+        query = MintedURI.Session.query(
+            func.lower(MintedURI.type), func.lower(MintedURI.name),
+            func.count())\
+            .filter(MintedURI.superseded_by == None)\
+            .group_by(func.lower(MintedURI.type), func.lower(MintedURI.name))
+    return query.having(func.count() > 1).all()
+
+
+def create_search_indexes():
+    '''
+    Enable pg_trgm and add trigram indexes on the searched columns.
+
+    The indexes let Postgres answer the `ILIKE '%q%'` searches in
+    MintedURI.search without scanning the whole table. If the extension
+    can not be enabled, for example because the database user is not
+    allowed to, search falls back to plain ILIKE filtering.
+    '''
+    global _trigram_search
+    try:
+        with model.meta.engine.begin() as connection:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for column in ('name', 'type'):
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS minted_uri_{0}_trgm_idx '
+                    'ON minted_uri USING gin ({0} gin_trgm_ops)'
+                    .format(column))
+    except DBAPIError as e:
+        log.warning('Could not create trigram indexes: %s', e)
+        print("Could not enable pg_trgm -- search will not be indexed")
+        return
+    _trigram_search = True
+    print("Created Minted URI search indexes")
+
+
+def trigram_search_available():
+    '''
+    Whether pg_trgm is enabled, checked once per process.
+    '''
+    global _trigram_search
+    if _trigram_search is None:
+        _trigram_search = MintedURI.Session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        ).first() is not None
+    return _trigram_search
+
 
 def define_table():
     global minted_uri_table
@@ -78,14 +230,6 @@ def name_and_type_unique(name, context):
     return name
 
 
-def uri_unique(uri, context):
-    result = MintedURI.Session.query(MintedURI).\
-        filter_by(uri=uri).first()
-    if result:
-        raise Invalid(_('There is an existing identical URI, please submit the form again to generate a new one'))
-    return uri
-
-
 def no_type_change(type, context):
     old_type = context.get('type')
     if type != old_type:
@@ -106,6 +250,14 @@ def default_schema():
     return schema
 
 
+def mint_schema():
+    # Uniqueness is enforced by the minted_uri indexes when the row is
+    # inserted, see _insert_minted_uri and bulk_create
+    schema = default_schema()
+    schema['name'] = [not_empty, ensure_str, remove_whitespace]
+    return schema
+
+
 def update_schema():
     schema = {
         'type': [no_type_change],
@@ -116,15 +268,137 @@ def update_schema():
 
 
 def generate_uri(type):
+    return build_uri(type, str(uuid.uuid1()))
+
+
+def build_uri(type, guid):
     domain = config.get('ckan.site_url', '').strip()
     namespace = path.join('id', type.lower())
-    guid = str(uuid.uuid1())
     path_section = quote(path.join(namespace, guid))
 
     # Final uri is [site_url]/id/[type]/[guid]
     return urljoin(domain, path_section)
 
 
+def _get_resolved_uri_cache():
+    global _resolved_uri_cache
+    if _resolved_uri_cache is None:
+        _resolved_uri_cache = TTLCache(
+            maxsize=int(config.get(
+                'ckanext.dia.uri_resolver.cache_size', 4096)),
+            ttl=int(config.get('ckanext.dia.uri_resolver.cache_ttl', 300)))
+    return _resolved_uri_cache
+
+
+def _register_version():
+    '''
+    When the register last changed: the latest time any URI was minted or
+    updated. Both maxima are read from indexes.
+    '''
+    return MintedURI.Session.execute(
+        "SELECT greatest((SELECT max(created_at) FROM minted_uri), "
+        "(SELECT max(updated_at) FROM minted_uri))").scalar()
+
+
+def _check_resolved_uri_cache():
+    '''
+    Clear the resolved URI cache if the register has changed since it was
+    filled, which may have been by another process.
+
+    The version is read from the database at most every
+    `ckanext.dia.uri_resolver.version_check_interval` seconds.
+    '''
+    global _resolved_uri_version, _resolved_uri_version_checked_at
+    now = time.monotonic()
+    interval = int(config.get(
+        'ckanext.dia.uri_resolver.version_check_interval', 5))
+    if _resolved_uri_version_checked_at is not None and \
+            now - _resolved_uri_version_checked_at < interval:
+        return
+    version = _register_version()
+    if version != _resolved_uri_version:
+        _get_resolved_uri_cache().clear()
+        _resolved_uri_version = version
+    _resolved_uri_version_checked_at = now
+
+
+def invalidate_resolved_uris():
+    '''
+    Forget every cached resolution after a URI is minted or changed, as a
+    change can alter how any URI in its chain resolves.
+    '''
+    if _resolved_uri_cache is not None:
+        _resolved_uri_cache.clear()
+
+
+def _is_type_name_conflict(error):
+    '''
+    Whether an IntegrityError was raised by the unique index on the type and
+    name of live URIs.
+    '''
+    diag = getattr(error.orig, 'diag', None)
+    return getattr(diag, 'constraint_name', None) == 'minted_uri_type_name_idx'
+
+
+# Attempts at minting a URI whose generated guid happens to be taken
+MINT_ATTEMPTS = 3
+
+
+def _insert_minted_uri(type, name, created_by_id, uri_id=None):
+    '''
+    Mint a URI for `type` and `name` in a single INSERT statement.
+
+    A clash with an existing URI is skipped by ON CONFLICT and retried with a
+    new guid, a clash with a live URI of the same type and name is caught in
+    a savepoint. Either is reported with the same ValidationError the form
+    validators raise. The new row is returned as a MintedURI attached to the
+    session, which still has to be committed.
+
+    Until the unique indexes are confirmed to exist, both rules are checked
+    with queries before a plain INSERT instead.
+    '''
+    indexed = minted_uri_indexes_available()
+    if not indexed:
+        try:
+            name_and_type_unique(name, {'type': type})
+        except Invalid as e:
+            raise ValidationError({'name': [e.error]})
+
+    for attempt in range(MINT_ATTEMPTS):
+        values = {
+            'uri': generate_uri(type),
+            'type': type,
+            'name': name,
+            'created_by_id': created_by_id,
+            'created_at': datetime.datetime.utcnow(),
+        }
+        if uri_id is not None:
+            values['id'] = uri_id
+        statement = pg_insert(minted_uri_table).values(**values)
+        if indexed:
+            statement = statement.on_conflict_do_nothing(
+                index_elements=['uri'])
+        elif MintedURI.Session.query(MintedURI.id)\
+                .filter_by(uri=values['uri']).first() is not None:
+            log.debug('Minted URI %s already exists, retrying', values['uri'])
+            continue
+        statement = statement.returning(*minted_uri_table.c)
+        try:
+            with MintedURI.Session.begin_nested():
+                row = MintedURI.Session.execute(statement).first()
+        except IntegrityError as e:
+            if not _is_type_name_conflict(e):
+                raise
+            raise ValidationError({'name': [_('That URI is already reserved (same type and name as an existing URI)')]})
+        if row is not None:
+            instance = MintedURI(**dict(row))
+            make_transient_to_detached(instance)
+            MintedURI.Session.add(instance)
+            return instance
+        log.debug('Minted URI %s already exists, retrying', values['uri'])
+    raise ValidationError({'uri': [_('There is an existing identical URI, please submit the form again to generate a new one')]})
+
+
 def set_updated_props(model, updated_by_id):
     model.updated_by_id = updated_by_id
     model.updated_at = datetime.datetime.utcnow()
@@ -152,30 +426,106 @@ class MintedURI(DomainObject):
         The given `name` should be unique within the `type` (or namespace).
         '''
         # Validate form input data
-        validated_data, errors = validate(data_dict, default_schema(), data_dict)
+        validated_data, errors = validate(data_dict, mint_schema(), data_dict)
         if errors:
             raise ValidationError(errors)
 
-        # Generate a URI from the validated data
-        type = validated_data.get('type')
-        name = validated_data.get('name')
-        created_by_id = validated_data.get('created_by_id')
-        uri = generate_uri(type)
+        try:
+            model = _insert_minted_uri(
+                validated_data.get('type'),
+                validated_data.get('name'),
+                validated_data.get('created_by_id'),
+            )
+            MintedURI.Session.commit()
+        except Exception:
+            MintedURI.Session.rollback()
+            raise
+        invalidate_resolved_uris()
+
+        return model
 
-        # Validate that the URI is unique
-        valid_uri, errors = validate({ 'uri': uri }, { 'uri': [uri_unique]})
+    @classmethod
+    def bulk_create(cls, data_dicts):
+        '''
+        Create a new MintedURI instance for each of `data_dicts`.
+
+        The whole batch is validated first, with a single query checking
+        that no `name` is already reserved within its `type`, and the rows
+        are then inserted together in one transaction. If any row is
+        invalid nothing is minted and the ValidationError lists the errors
+        by row number.
+        '''
+        errors = {}
+        rows = {}
+        for index, data_dict in enumerate(data_dicts):
+            row = _('Row {}').format(index + 1)
+            if not isinstance(data_dict, dict):
+                errors[row] = [_('Must be an object with a type and name')]
+                continue
+            validated_data, row_errors = validate(
+                data_dict, mint_schema(), data_dict)
+            if row_errors:
+                errors[row] = [
+                    '{}: {}'.format(field, message)
+                    for field, messages in row_errors.items()
+                    for message in messages]
+                continue
+            key = (validated_data['type'].lower(),
+                   validated_data['name'].lower())
+            if key in rows:
+                errors[row] = [_('Same type and name as row {}').format(
+                    rows[key][0] + 1)]
+                continue
+            rows[key] = (index, validated_data)
+
+        if rows:
+            # Matched by the input row's index, so the rows are lowercased
+            # by Postgres on both sides, as the unique index does, rather
+            # than compared with Python's lower()
+            batch = sorted(rows.values())
+            reserved = MintedURI.Session.execute(
+                'SELECT DISTINCT batch.row_index '
+                'FROM unnest(CAST(:indexes AS integer[]), '
+                'CAST(:types AS text[]), CAST(:names AS text[])) '
+                'AS batch (row_index, type, name) '
+                'JOIN minted_uri ON lower(minted_uri.type) = lower(batch.type) '
+                'AND lower(minted_uri.name) = lower(batch.name) '
+                'WHERE minted_uri.superseded_by IS NULL',
+                {'indexes': [index for index, data in batch],
+                 'types': [data['type'] for index, data in batch],
+                 'names': [data['name'] for index, data in batch]})
+            for (index,) in reserved:
+                row = _('Row {}').format(index + 1)
+                errors[row] = [_('That URI is already reserved (same type and name as an existing URI)')]
         if errors:
             raise ValidationError(errors)
 
-        model = MintedURI(
-            uri=valid_uri.get('uri'),
-            type=type,
-            name=name,
-            created_by_id=created_by_id,
-        )
-        model.save()
-
-        return model
+        created_at = datetime.datetime.utcnow()
+        values = []
+        for index, validated_data in sorted(rows.values()):
+            values.append({
+                'uri': generate_uri(validated_data['type']),
+                'type': validated_data['type'],
+                'name': validated_data['name'],
+                'created_by_id': validated_data['created_by_id'],
+                'created_at': created_at,
+            })
+        if not values:
+            return []
+
+        try:
+            MintedURI.Session.execute(minted_uri_table.insert(), values)
+            MintedURI.Session.commit()
+            invalidate_resolved_uris()
+        except IntegrityError:
+            MintedURI.Session.rollback()
+            raise ValidationError({'name': [_('Some of these URIs were reserved while the batch was being minted, please try again')]})
+
+        uris = [value['uri'] for value in values]
+        by_uri = dict(
+            (instance.uri, instance) for instance in
+            MintedURI.Session.query(MintedURI).filter(MintedURI.uri.in_(uris)))
+        return [by_uri[uri] for uri in uris]
 
     @classmethod
     def update(cls, uri_id, data_dict):
@@ -202,36 +552,161 @@ class MintedURI(DomainObject):
         updated_by_id = validated_data.get('updated_by_id')
 
         if regenerating:
-            # Validate that the new URI is unique
-            uri = generate_uri(type)
-            valid_uri, errors = validate({ 'uri': uri }, { 'uri': [uri_unique]})
-            if errors:
-                raise ValidationError(errors)
-
-            # Create a new minted URI with the same type and name
-            new_model = MintedURI(
-                uri=valid_uri.get('uri'),
-                type=type,
-                name=name,
-                created_by_id=updated_by_id,
-            )
-            new_model.save()
+            # Take the new URI's id up front so the original can be marked as
+            # superseded before the new one is inserted, otherwise both would
+            # be live with the same type and name
+            new_id = MintedURI.Session.execute(
+                select([func.nextval('minted_uri_id_seq')])).scalar()
 
             # Mark original URI as superseded by the new one
             # so that we can trace the links between them if needed
-            model.superseded_by = new_model.id
+            model.superseded_by = new_id
             model = set_updated_props(model, updated_by_id)
-            model.save()
+            try:
+                MintedURI.Session.flush()
+                # Create a new minted URI with the same type and name
+                new_model = _insert_minted_uri(
+                    type, name, updated_by_id, uri_id=new_id)
+                MintedURI.Session.commit()
+            except Exception:
+                MintedURI.Session.rollback()
+                raise
+            invalidate_resolved_uris()
 
             return new_model
 
         # Only updating the name on the URI
         model.name = name
         model = set_updated_props(model, updated_by_id)
-        model.save()
+        try:
+            model.save()
+        except IntegrityError as e:
+            # the name was taken by another URI after it was validated
+            MintedURI.Session.rollback()
+            if not _is_type_name_conflict(e):
+                raise
+            raise ValidationError({'name': [_('That URI is already reserved (same type and name as an existing URI)')]})
+        invalidate_resolved_uris()
 
         return model
 
+    @classmethod
+    def resolve(cls, uri):
+        '''
+        Resolve a minted URI to the name currently reserved against it.
+
+        If the URI has been superseded the chain is followed to the live URI,
+        whose name is returned along with its `current_uri`. Results are
+        cached in memory until any URI is minted or changed, by any process,
+        see _check_resolved_uri_cache. Returns None for an unknown URI.
+        '''
+        _check_resolved_uri_cache()
+        cache = _get_resolved_uri_cache()
+        resolved = cache.get(uri)
+        if resolved is not None:
+            return resolved
+
+        instance = MintedURI.Session.query(MintedURI).filter_by(uri=uri).first()
+        if instance is None:
+            return None
+        current = instance
+        if instance.superseded_by is not None:
+            current = MintedURI.resolve_current(uri) or instance
+
+        resolved = {
+            'uri': instance.uri,
+            'type': instance.type,
+            'name': current.name,
+            'current_uri': current.uri,
+            'superseded': current.id != instance.id,
+            'created_at': instance.created_at.isoformat()
+            if instance.created_at else None,
+        }
+        cache.set(uri, resolved)
+        return resolved
+
+    @classmethod
+    def history(cls, uri_id):
+        '''
+        Get every version of a URI, oldest first.
+
+        The `superseded_by` links are followed both back to the URI first
+        minted for the entity and forward to the live one, in a single
+        recursive query.
+        '''
+        table = minted_uri_table
+
+        later = select([table.c.id, table.c.superseded_by])\
+            .where(table.c.id == uri_id)\
+            .cte('later_versions', recursive=True)
+        following = table.alias()
+        later = later.union(
+            select([following.c.id, following.c.superseded_by])
+            .where(following.c.id == later.c.superseded_by))
+
+        earlier = select([table.c.id])\
+            .where(table.c.id == uri_id)\
+            .cte('earlier_versions', recursive=True)
+        preceding = table.alias()
+        earlier = earlier.union(
+            select([preceding.c.id])
+            .where(preceding.c.superseded_by == earlier.c.id))
+
+        version_ids = union(select([later.c.id]), select([earlier.c.id]))
+        return MintedURI.Session.query(MintedURI)\
+            .filter(MintedURI.id.in_(version_ids))\
+            .order_by(MintedURI.created_at, MintedURI.id)\
+            .all()
+
+    @classmethod
+    def resolve_current(cls, uri):
+        '''
+        Get the live version of a URI, following `superseded_by` links in a
+        single query. Returns None for an unknown URI.
+        '''
+        return cls.resolve_current_many([uri]).get(uri)
+
+    @classmethod
+    def resolve_current_many(cls, uris):
+        '''
+        Get the live version of each of `uris` in a single recursive query.
+
+        Returns a dict mapping each known URI to its live MintedURI, which is
+        the URI's own instance when it has not been superseded.
+        '''
+        uris = list(uris)
+        if not uris:
+            return {}
+        table = minted_uri_table
+
+        chain = select([
+            table.c.uri.label('origin'), table.c.id, table.c.superseded_by])\
+            .where(table.c.uri.in_(uris))\
+            .cte('uri_chain', recursive=True)
+        following = table.alias()
+        chain = chain.union(
+            select([chain.c.origin, following.c.id, following.c.superseded_by])
+            .where(following.c.id == chain.c.superseded_by))
+
+        query = MintedURI.Session.query(chain.c.origin, MintedURI)\
+            .join(MintedURI, MintedURI.id == chain.c.id)\
+            .filter(MintedURI.superseded_by == None)
+        return dict((origin, current) for origin, current in query)
+
+    @classmethod
+    def get_many(cls, uri_ids=(), uris=()):
+        '''
+        Get the URI instances with any of the given IDs or URIs in one query.
+        '''
+        filters = []
+        if uri_ids:
+            filters.append(MintedURI.id.in_(list(uri_ids)))
+        if uris:
+            filters.append(MintedURI.uri.in_(list(uris)))
+        if not filters:
+            return []
+        return MintedURI.Session.query(MintedURI).filter(or_(*filters)).all()
+
     @classmethod
     def get_list(cls, data_dict):
         q = data_dict.get('q', '')
@@ -245,9 +720,42 @@ class MintedURI(DomainObject):
 
         return query
 
+    @classmethod
+    def get_keyset_page(cls, data_dict, limit, after=None, before=None):
+        '''
+        Get up to `limit` live URIs, newest first, that sort after (or
+        before) a `(created_at, id)` position from a previous page.
+
+        Seeking on the `(created_at, id)` index costs the same on every
+        page, unlike an OFFSET. Search results are filtered but not
+        ranked. Returns the URIs and whether there are more in the
+        direction being paged.
+        '''
+        query = cls.get_list(data_dict).order_by(None)
+        position = tuple_(cls.created_at, cls.id)
+        if before is not None:
+            query = query.filter(position > tuple_(*before))\
+                .order_by(cls.created_at, cls.id)
+        else:
+            if after is not None:
+                query = query.filter(position < tuple_(*after))
+            query = query.order_by(desc(cls.created_at), desc(cls.id))
+
+        items = query.limit(limit + 1).all()
+        more = len(items) > limit
+        items = items[:limit]
+        if before is not None:
+            items.reverse()
+        return items, more
+
     @classmethod
     def search(cls, querystr, sqlalchemy_query):
-        '''Search name and type'''
+        '''
+        Search name and type
+
+        When pg_trgm is available the filter is served by the trigram
+        indexes and the closest matches are ordered first.
+        '''
         query = sqlalchemy_query
         qstr = '%' + querystr + '%'
         filters = [
@@ -255,6 +763,12 @@ class MintedURI(DomainObject):
             cls.type.ilike(qstr),
         ]
         query = query.filter(or_(*filters))
+        if trigram_search_available():
+            rank = func.greatest(
+                func.similarity(cls.name, querystr),
+                func.similarity(cls.type, querystr))
+            query = query.order_by(None)\
+                .order_by(desc(rank), desc(cls.created_at))
         return query
 
     def __repr__(self):
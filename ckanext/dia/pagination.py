@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from ckan.plugins import toolkit as tk
+
+
+def encode_cursor(item):
+    '''
+    Encode the `(created_at, id)` position of an item for use in a URL.
+    '''
+    return u'{}_{}'.format(item.created_at.isoformat(), item.id)
+
+
+def decode_cursor(value):
+    '''
+    Decode a cursor made by `encode_cursor`, None if it is missing or
+    malformed.
+    '''
+    if not value:
+        return None
+    created_at, _, item_id = value.rpartition(u'_')
+    try:
+        return (datetime.datetime.fromisoformat(created_at), int(item_id))
+    except ValueError:
+        return None
+
+
+class KeysetPage(object):
+    '''
+    A page of results fetched by seeking from the previous page's last item
+    rather than by offset.
+
+    Offers the parts of `h.Page` the templates use: `items` and `pager()`,
+    which links to the newer and older pages.
+    '''
+
+    def __init__(self, items, more, url_for, after=None, before=None):
+        self.items = items
+        self.next_url = None
+        self.previous_url = None
+
+        if not items:
+            return
+        # paging forward always leaves newer items behind us and paging
+        # backward always leaves older ones, `more` covers the other side
+        has_older = more if before is None else True
+        has_newer = (more if before is not None
+                     else after is not None)
+        if has_older:
+            self.next_url = url_for(after=encode_cursor(items[-1]))
+        if has_newer:
+            self.previous_url = url_for(before=encode_cursor(items[0]))
+
+    def pager(self, **kwargs):
+        return tk.render_snippet(
+            u'uris/snippets/keyset_pager.html',
+            {u'previous_url': self.previous_url, u'next_url': self.next_url})
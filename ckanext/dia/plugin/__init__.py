@@ -5,12 +5,12 @@ import ckan.plugins as p
 from ckan.plugins import toolkit as tk
 from ckan import logic
 
-from ckanext.dia import schema, converters, views
+from ckanext.dia import schema, converters, views, actions, auth
 from ckanext.dia.validators import (
     isodate, extra_key_not_in_root_schema,
     force_lower, natural_num_or_missing
 )
-from ckanext.dia.model import define_table
+from ckanext.dia.model import define_table, missing_minted_uri_indexes
 
 if p.toolkit.check_ckan_version(min_version='2.9.0'):
     from ckanext.dia.plugin.flask_plugin import (
@@ -47,12 +47,25 @@ class DIASchemaPlugin(p.SingletonPlugin):
 
 class DIAUriMintingPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IBlueprint)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
+
+    # IActions
+
+    def get_actions(self):
+        return actions.get_actions()
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return auth.get_auth_functions()
 
     # IBlueprint
 
     def get_blueprint(self):
-        return views.uri_minter
+        return [views.uri_minter, views.uri_resolver]
 
     # IConfigurer
 
@@ -61,6 +74,21 @@ class DIAUriMintingPlugin(p.SingletonPlugin):
 
         tk.add_template_directory(config, '../templates')
 
+    # IConfigurable
+
+    def configure(self, config):
+        try:
+            missing = missing_minted_uri_indexes()
+        except Exception as e:
+            log.warning('Could not check the minted_uri indexes: %s', e)
+            return
+        if missing:
+            log.warning(
+                'The minted_uri table is missing the unique indexes %s, run '
+                '`ckan dia init-minted-uri-db`. Until then uniqueness is '
+                'only checked by queries before each URI is minted.',
+                ', '.join(missing))
+
 
 class DIANoHomepagePlugin(DIANoHomepageMixin, p.SingletonPlugin):
     """
@@ -0,0 +1,46 @@
+# encoding: utf-8
+import json
+
+import pytest
+
+from ckan.logic import ValidationError
+from ckan.tests import helpers
+
+from ckanext.dia.harvester.dcat import DIADCATJSONHarvester
+
+
+class TestValidateConfig(object):
+
+    def test_valid_config_is_returned(self):
+        config = json.dumps({'default_tags': ['nz'], 'default_groups': []})
+        assert DIADCATJSONHarvester().validate_config(config) == config
+
+    def test_invalid_config_raises(self):
+        with pytest.raises(ValueError):
+            DIADCATJSONHarvester().validate_config(
+                json.dumps({'default_tags': 'nz'}))
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'harvest diadcatjsonharvester')
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestSaveSourceConfig(object):
+
+    def _create_source(self, config):
+        return helpers.call_action(
+            'harvest_source_create',
+            name='dia-dcat-json-source',
+            title='DIA DCAT JSON source',
+            url='http://example.com/data.json',
+            source_type='dcat_json',
+            config=config)
+
+    def test_source_with_config_is_saved(self):
+        config = json.dumps(
+            {'default_tags': ['nz', {'name': 'govt'}], 'default_groups': []})
+        source = self._create_source(config)
+        assert source['config'] == config
+
+    def test_source_with_invalid_config_is_rejected(self):
+        with pytest.raises(ValidationError) as e:
+            self._create_source(json.dumps({'default_groups': 'group'}))
+        assert 'config' in e.value.error_dict
@@ -0,0 +1,43 @@
+# encoding: utf-8
+import pytest
+
+from ckan.logic import ValidationError
+from ckan.tests import factories
+
+from ckanext.dia import model as dia_model
+from ckanext.dia.model import MintedURI
+
+
+@pytest.fixture
+def minted_uri_db(clean_db):
+    dia_model.db_setup()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'diauriminting')
+@pytest.mark.usefixtures('with_plugins', 'minted_uri_db')
+class TestBulkCreate(object):
+
+    def test_mints_non_ascii_names(self):
+        user = factories.User()
+        minted = MintedURI.bulk_create([
+            {'type': 'organisation', 'name': u'Te Whatu Ora İstanbul',
+             'created_by_id': user['id']},
+            {'type': 'organisation', 'name': u'Tūhoe',
+             'created_by_id': user['id']},
+        ])
+        assert [uri.name for uri in minted] == [
+            u'Te Whatu Ora İstanbul', u'Tūhoe']
+
+    def test_reserved_non_ascii_name_is_a_validation_error(self):
+        user = factories.User()
+        MintedURI.create({'type': 'organisation', 'name': u'İstanbul',
+                          'created_by_id': user['id']})
+
+        with pytest.raises(ValidationError) as e:
+            MintedURI.bulk_create([
+                {'type': 'organisation', 'name': u'Tūhoe',
+                 'created_by_id': user['id']},
+                {'type': 'organisation', 'name': u'İstanbul',
+                 'created_by_id': user['id']},
+            ])
+        assert list(e.value.error_dict) == ['Row 2']
@@ -1,8 +1,16 @@
 from __future__ import print_function
+import csv
+import datetime
+import json
+import os
 import sys
 import logging
 import itertools
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+import flask
+import sqlalchemy as sa
 import ckan.logic as logic
 import ckan.model as model
 from ckan.common import config
@@ -11,55 +19,106 @@ from ckan.model import Session, User, ApiToken
 logger = logging.getLogger(__name__)
 
 
-def cleanup_datastore():
-    user = logic.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {
-        'model': model,
-        'session': model.Session,
-        'user': user['name']
-    }
-    try:
-        logic.check_access('datastore_delete', context)
-        logic.check_access('resource_show', context)
-    except logic.NotAuthorized:
-        print("User is not authorized to perform this action.")
+def cleanup_datastore(workers=1, rate=100, max_lock_waits=None,
+                      state_file=None, resume=False, dry_run=False,
+                      max_tables=None, output_json=False):
+    """
+    Deletes datastore tables whose resource no longer exists.
+
+    Deletions run on `workers` threads, at no more than `rate` per second
+    (0 for no limit), and back off while more than `max_lock_waits`
+    Postgres sessions are waiting on locks.
+
+    Progress is checkpointed to `state_file` after every batch of tables.
+    With `resume` the scan carries on after the last checkpointed table,
+    and `max_tables` stops the run once that many tables have been checked
+    so that a large cleanup can be done in slices. A `dry_run` only reports
+    the orphaned tables and leaves the checkpoint alone.
+
+    Returns the summary, which is also printed as JSON if `output_json`.
+    """
+    workers = int(workers)
+    max_tables = int(max_tables) if max_tables else None
+    throttle = DeletionThrottle(
+        rate=float(rate) if rate else None,
+        max_lock_waits=(int(max_lock_waits)
+                        if max_lock_waits is not None else None))
+    state_file = state_file or _default_cleanup_state_file()
+    if not state_file:
+        print("Set ckan.storage_path or "
+              "ckanext.dia.cleanup_datastore.state_file, or pass "
+              "--state-file, to say where to checkpoint progress",
+              file=sys.stderr)
         sys.exit(1)
 
-    # query datastore to get all resources from the _table_metadata
-    print("Loading metadata records from datastore")
-    all_datastore_tables = _get_all_datastore_tables(context)
+    context = _get_cleanup_context()
+
+    state = _load_cleanup_state(state_file) if resume else None
+    if state and not state['complete']:
+        print("Resuming after datastore table '{}'".format(
+            state['last_table']))
+    else:
+        state = _new_cleanup_state()
+    state['dry_run'] = bool(dry_run)
 
+    # count the tables up front so that progress can be reported, the
+    # metadata records themselves are streamed a page at a time
+    print("Counting datastore tables")
+    table_count_before = _count_datastore_tables()
+    remaining_count = _count_datastore_tables(after=state['last_table'])
+
+    scan_size = 1000
     chunk_size = 100
-    total_deleted = 0
-    failed_deletes = []
-    for offset in itertools.count(start=0, step=chunk_size):
-        end_chunk_index = offset + chunk_size
-        datastore_tables_chunk = all_datastore_tables[offset:end_chunk_index]
+    checked_count = 0
+    tables = _iter_datastore_tables(
+        page_size=scan_size, after=state['last_table'])
+    if max_tables:
+        tables = itertools.islice(tables, max_tables)
+    for datastore_tables_chunk in _chunked(tables, scan_size):
+        checked_count += len(datastore_tables_chunk)
         orphan_list = _find_orphaned_datastore_tables(
             context, datastore_tables_chunk)
-        if len(orphan_list) > 0:
-            # Run a small chunk of the dataset to avoid locking up the
-            # database for a *really* long time(read: until postgres is
-            # restarted)
-            delete_count, error_list = _delete_orphans(context, orphan_list)
-            total_deleted += delete_count
-            failed_deletes.extend(error_list)
+        state['orphaned'] += len(orphan_list)
+        # Run a small chunk of the dataset to avoid locking up the
+        # database for a *really* long time(read: until postgres is
+        # restarted)
+        for orphan_chunk in _chunked([] if dry_run else orphan_list,
+                                     chunk_size):
+            delete_count, error_list = _delete_orphans(
+                context, orphan_chunk, workers=workers, throttle=throttle)
+            state['deleted'] += delete_count
+            state['failed'].extend(error_list)
             print('Deleted in this chunk: {}'.format(delete_count))
             print('Errored in this chunk: {}'.format(len(error_list)))
 
-        if end_chunk_index >= len(all_datastore_tables):
-            break
+        state['checked'] += len(datastore_tables_chunk)
+        state['last_table'] = datastore_tables_chunk[-1]['name']
+        if not dry_run:
+            _save_cleanup_state(state_file, state)
+
+        if checked_count < remaining_count:
+            print('{} tables checked, {} more to go...'.format(
+                checked_count, remaining_count - checked_count))
 
-        print('{} tables checked, {} more to go...'.format(
-            end_chunk_index, len(all_datastore_tables) - end_chunk_index))
-        time.sleep(1)
+    state['complete'] = checked_count >= remaining_count
+    if state['complete']:
+        print('Cleanup complete!')
+    else:
+        print('Stopped after {} tables, run again with --resume to '
+              'continue'.format(checked_count))
+    if not dry_run:
+        _save_cleanup_state(state_file, state)
 
-    updated_table_count = len(_get_all_datastore_tables(context))
+    table_count_after = _count_datastore_tables()
+    failed_deletes = state['failed']
 
-    print('Cleanup complete!')
     print('Total datastore tables before: {} and after: {}'.format(
-        len(all_datastore_tables), updated_table_count))
-    print('Total orphaned datastore tables deleted: {}'.format(total_deleted))
+        table_count_before, table_count_after))
+    if dry_run:
+        print('Total orphaned datastore tables found: {}'.format(
+            state['orphaned']))
+    print('Total orphaned datastore tables deleted: {}'.format(
+        state['deleted']))
     print('Total errors when attempting deletion: {}'
           .format(len(failed_deletes)))
     if len(failed_deletes) > 0 and len(failed_deletes) < 10:
@@ -67,23 +126,250 @@ def cleanup_datastore():
         print('Datastore table names that failed to delete: {}'
               .format(failed_deletes))
 
+    summary = dict(
+        state,
+        tables_before=table_count_before,
+        tables_after=table_count_after,
+        checked_this_run=checked_count)
+    if output_json:
+        print(json.dumps(summary))
+    return summary
+
+
+def report_orphaned_datastore_tables(output=None, output_format='csv',
+                                    max_tables=None):
+    """
+    Writes a report of the orphaned datastore tables, largest first,
+    without deleting anything.
+
+    Each row has the table name, its row count and its total size on disk
+    in bytes, indexes and TOAST data included. Rows are counted exactly,
+    which scans each orphaned table. The report is written to `output`
+    (stdout by default) as CSV or JSON, progress goes to stderr.
+    """
+    max_tables = int(max_tables) if max_tables else None
+    context = _get_cleanup_context()
+
+    scan_size = 1000
+    checked_count = 0
+    orphans = []
+    tables = _iter_datastore_tables(page_size=scan_size)
+    if max_tables:
+        tables = itertools.islice(tables, max_tables)
+    for datastore_tables_chunk in _chunked(tables, scan_size):
+        checked_count += len(datastore_tables_chunk)
+        orphan_list = _find_orphaned_datastore_tables(
+            context, datastore_tables_chunk, out=sys.stderr)
+        orphans.extend(_get_datastore_table_sizes(orphan_list))
+        print('{} tables checked, {} orphaned'.format(
+            checked_count, len(orphans)), file=sys.stderr)
+
+    orphans.sort(key=lambda table: table['total_bytes'], reverse=True)
+
+    close_output = False
+    if output is None or output == '-':
+        output = sys.stdout
+    elif not hasattr(output, 'write'):
+        output = open(output, 'w')
+        close_output = True
+    try:
+        if output_format == 'json':
+            json.dump({
+                'tables_checked': checked_count,
+                'total_rows': sum(t['row_count'] for t in orphans),
+                'total_bytes': sum(t['total_bytes'] for t in orphans),
+                'tables': orphans,
+            }, output, indent=2)
+            output.write('\n')
+        else:
+            writer = csv.DictWriter(
+                output, fieldnames=['name', 'row_count', 'total_bytes'])
+            writer.writeheader()
+            writer.writerows(orphans)
+    finally:
+        if close_output:
+            output.close()
+    return orphans
+
+
+def _get_datastore_table_sizes(table_names):
+    if not table_names:
+        return []
+    query = sa.text(
+        u'SELECT c.relname AS name, '
+        u'pg_total_relation_size(c.oid) AS total_bytes '
+        u'FROM pg_class c '
+        u'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        u"WHERE n.nspname = 'public' AND c.relname = ANY(:names)")
+    with _get_datastore_engine().connect() as connection:
+        sizes = []
+        for row in connection.execute(query, names=list(table_names)):
+            # counted exactly, the planner's reltuples estimate can be far
+            # out for tables that have not been analysed recently
+            row_count = connection.execute(
+                u'SELECT count(*) FROM "{}"'.format(
+                    row['name'].replace('"', '""'))).scalar()
+            sizes.append({
+                'name': row['name'],
+                'row_count': row_count,
+                'total_bytes': row['total_bytes'],
+            })
+    return sizes
+
+
+def _get_cleanup_context():
+    user = logic.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user['name']
+    }
+    try:
+        logic.check_access('datastore_delete', context)
+        logic.check_access('resource_show', context)
+    except logic.NotAuthorized:
+        print("User is not authorized to perform this action.")
+        sys.exit(1)
+    return context
+
+
+def _new_cleanup_state():
+    return {
+        'last_table': u'',
+        'checked': 0,
+        'orphaned': 0,
+        'deleted': 0,
+        'failed': [],
+        'complete': False,
+        'started_at': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+def _default_cleanup_state_file():
+    """
+    The configured checkpoint file, by default in a `dia` directory under
+    `ckan.storage_path` that only CKAN's user writes to, rather than a
+    predictable path in the shared temp directory. None if neither is set.
+    """
+    state_file = config.get('ckanext.dia.cleanup_datastore.state_file')
+    if state_file:
+        return state_file
+    storage_path = config.get('ckan.storage_path')
+    if not storage_path:
+        return None
+    state_dir = os.path.join(storage_path, 'dia')
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, mode=0o700)
+    return os.path.join(state_dir, 'cleanup-datastore.json')
+
 
-def _get_all_datastore_tables(context):
-    result_set = logic.get_action('datastore_search')(
-        context,
-        {
-            'resource_id': '_table_metadata',
-            'limit': 50000,  # arbitrarily high, but default limit is 100
-        }
-    )
+def _load_cleanup_state(state_file):
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # fill in any keys an older checkpoint might be missing
+    return dict(_new_cleanup_state(), **state)
+
+
+def _save_cleanup_state(state_file, state):
+    """
+    Writes the checkpoint to a temporary file first and then moves it into
+    place, so an interrupted run never leaves a partial checkpoint behind.
+    """
+    state['updated_at'] = datetime.datetime.utcnow().isoformat()
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def _get_datastore_engine():
+    from ckanext.datastore.backend.postgres import get_read_engine
+    return get_read_engine()
+
+
+def _count_datastore_tables(after=u''):
+    with _get_datastore_engine().connect() as connection:
+        return connection.execute(
+            sa.text(u'SELECT count(*) FROM "_table_metadata" '
+                    u'WHERE alias_of IS NULL AND name > :after'),
+            after=after
+        ).scalar()
+
+
+def _iter_datastore_tables(page_size=1000, after=u''):
+    """
+    Yields the `_table_metadata` record of every datastore table, ordered
+    by name, skipping alias records.
+
+    Records are read in pages keyed on the last name seen, so memory use
+    stays constant however many tables there are and tables deleted while
+    iterating do not shift later pages.
+    """
+    query = sa.text(
+        u'SELECT name, alias_of FROM "_table_metadata" '
+        u'WHERE alias_of IS NULL AND name > :after '
+        u'ORDER BY name LIMIT :limit')
+    engine = _get_datastore_engine()
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                query, after=after, limit=page_size).fetchall()
+        for row in rows:
+            yield {'name': row['name'], 'alias_of': row['alias_of']}
+        if len(rows) < page_size:
+            return
+        after = rows[-1]['name']
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
-    return result_set.get('records', [])
 
+def _delete_orphans(context, resource_id_list, workers=1, throttle=None):
+    """
+    Deletes the datastore tables of the given orphaned resource ids.
 
-def _delete_orphans(context, resource_id_list):
+    With more than one worker the deletions run on a thread pool. Every
+    deletion first waits on the `throttle`, if one is given.
+    """
     print('Batch deleting {} ophaned datastore records'
           .format(len(resource_id_list)))
 
+    def delete(resource_id):
+        if throttle is not None:
+            throttle.wait()
+        try:
+            return _delete_orphan(dict(context), resource_id)
+        finally:
+            if workers > 1:
+                model.Session.remove()
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                _in_app_context(delete), resource_id_list))
+    else:
+        results = [delete(resource_id) for resource_id in resource_id_list]
+
+    delete_errors = [resource_id for resource_id, deleted
+                     in zip(resource_id_list, results) if not deleted]
+    return (len(resource_id_list) - len(delete_errors), delete_errors)
+
+
+def _delete_orphan(context, resource_id):
+    """
+    Deletes the datastore table of a single orphaned resource and returns
+    whether the table is gone afterwards.
+    """
+
     def datastore_record_count(context, resource_id):
         """
         Wraps the search so that it returns None if NotFound,
@@ -100,64 +386,196 @@ def _delete_orphans(context, resource_id_list):
 
         return count
 
-    # delete orphaned datastore tables
-    delete_count = 0
-    delete_errors = []
+    count = datastore_record_count(context, resource_id)
+    if count is None:
+        print('No datastore table found for resource {}'
+              .format(resource_id))
+        return False
 
-    for resource_id in resource_id_list:
-        count = datastore_record_count(context, resource_id)
-        if count is None:
-            print('No datastore table found for resource {}'
-                  .format(resource_id))
-            delete_errors.append(resource_id)
-            continue
+    try:
+        logic.get_action('datastore_delete')(
+            context,
+            {'resource_id': resource_id, 'force': True}
+        )
+    except AttributeError as e:
+        # datastore_delete references resource.extras
+        # when there is no resource
+        if str(e) != "'NoneType' object has no attribute 'extras'":
+            raise(e)
 
-        try:
-            logic.get_action('datastore_delete')(
-                context,
-                {'resource_id': resource_id, 'force': True}
-            )
-        except AttributeError as e:
-            # datastore_delete references resource.extras
-            # when there is no resource
-            if e.message != "'NoneType' object has no attribute 'extras'":
-                raise(e)
-
-        count = datastore_record_count(context, resource_id)
-        if count is not None:
-            print('Datastore table {} failed to delete'.format(resource_id))
-            delete_errors.append(resource_id)
-        else:
-            delete_count += 1
+    count = datastore_record_count(context, resource_id)
+    if count is not None:
+        print('Datastore table {} failed to delete'.format(resource_id))
+        return False
+    return True
 
-    return (delete_count, delete_errors)
 
+def _in_app_context(func):
+    """
+    Wraps `func` so it runs in a request context of the current Flask app,
+    which CKAN actions expect, when it is called from a worker thread.
+    """
+    if not flask.has_app_context():
+        return func
+    app = flask.current_app._get_current_object()
 
-def _find_orphaned_datastore_tables(context, datastore_tables_chunk):
-    orphan_list = []
-    for record in datastore_tables_chunk:
-        try:
-            # ignore 'alias' records
-            if record['alias_of']:
-                continue
+    def wrapped(*args, **kwargs):
+        with app.test_request_context():
+            return func(*args, **kwargs)
+    return wrapped
 
-            logic.get_action('resource_show')(
-                context,
-                {'id': record['name']}
-            )
-            print("Resource '%s' found" % record['name'])
-        except logic.NotFound:
-            orphan_list.append(record['name'])
-            context.pop('__auth_audit', None)
-            print("Resource '%s' *not* found" % record['name'])
-        except KeyError:
-            continue
-        except Exception as e:
-            # Added as something did not check the authorization for
-            # doing a resource_show.
-            print("Unexpected error looking up resource: '%s'" % (
-                record['name']))
-            logger.exception("Unable to lookup resource: '%s'",
-                             record['name'], exc_info=e)
 
+class TokenBucket(object):
+    """
+    Limits operations to `rate` per second on average, allowing bursts of
+    up to `capacity` operations.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class DeletionThrottle(object):
+    """
+    Paces datastore deletions with a token bucket, and backs off
+    exponentially while more than `max_lock_waits` Postgres sessions are
+    waiting on locks.
+    """
+
+    def __init__(self, rate=None, max_lock_waits=None, check_interval=5,
+                 max_backoff=60):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.max_lock_waits = max_lock_waits
+        self.check_interval = check_interval
+        self.max_backoff = max_backoff
+        self._backoff = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.max_lock_waits is not None:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    if self._checked_at is None or \
+                            now - self._checked_at >= self.check_interval:
+                        self._checked_at = now
+                        lock_waits = _count_lock_waits()
+                        if lock_waits > self.max_lock_waits:
+                            self._backoff = min(
+                                max(self._backoff * 2, 1), self.max_backoff)
+                            print('{} sessions waiting on locks, backing off '
+                                  'for {}s'.format(lock_waits, self._backoff))
+                        else:
+                            self._backoff = 0
+                    backoff = self._backoff
+                if not backoff:
+                    break
+                time.sleep(backoff)
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+
+def _count_lock_waits():
+    # pg_stat_activity hides what other roles' sessions are waiting on from
+    # the read-only datastore user, pg_locks is readable by any role. It
+    # covers the whole cluster, and row lock waits show up as transactionid
+    # locks without a database, so those are not filtered out.
+    with _get_datastore_engine().connect() as connection:
+        return connection.execute(
+            u"SELECT count(DISTINCT pid) FROM pg_locks WHERE NOT granted"
+        ).scalar()
+
+
+def _find_orphaned_datastore_tables(context, datastore_tables_chunk,
+                                    out=None):
+    """
+    Returns the names of the datastore tables in the chunk that do not
+    belong to an active resource.
+
+    The whole chunk is checked with a single query against the resource
+    table rather than a resource_show per table.
+    """
+    table_names = [record['name'] for record in datastore_tables_chunk
+                   if not record.get('alias_of')]
+    if not table_names:
+        return []
+
+    session = context.get('session', model.Session)
+    active_resource_ids = set(
+        resource_id for (resource_id,) in session.query(model.Resource.id)
+        .filter(model.Resource.id.in_(table_names))
+        .filter(model.Resource.state == 'active'))
+
+    orphan_list = [name for name in table_names
+                   if name not in active_resource_ids]
+    print('{} of {} tables have an active resource'.format(
+        len(table_names) - len(orphan_list), len(table_names)), file=out)
+    for name in orphan_list:
+        print("Resource '%s' *not* found" % name, file=out)
     return orphan_list
+
+
+def mint_uris(source, input_format=None, batch_size=500, user=None,
+              output=None):
+    """
+    Mints a URI for every `type` and `name` read from `source`, a CSV file
+    with a header row or a file with one JSON object per line.
+
+    Entities are minted in batches of `batch_size`, each batch in a single
+    transaction. The minted URIs are written to `output` (stdout by
+    default) as CSV. Stops at the first batch that fails validation, the
+    batches before it stay minted.
+    """
+    batch_size = int(batch_size)
+    output = output or sys.stdout
+    if input_format is None:
+        input_format = 'jsonl' if getattr(source, 'name', '').endswith(
+            ('.jsonl', '.json')) else 'csv'
+
+    if user is None:
+        user = logic.get_action('get_site_user')(
+            {'ignore_auth': True}, {})['name']
+    context = {'model': model, 'session': model.Session, 'user': user}
+
+    if input_format == 'jsonl':
+        entities = (json.loads(line) for line in source if line.strip())
+    else:
+        entities = csv.DictReader(source)
+
+    writer = csv.DictWriter(
+        output, fieldnames=['uri', 'type', 'name'], extrasaction='ignore')
+    writer.writeheader()
+    minted_count = 0
+    for batch in _chunked(entities, batch_size):
+        try:
+            minted = logic.get_action('minted_uri_bulk_create')(
+                dict(context), {'uris': batch})
+        except logic.ValidationError as e:
+            print('Batch starting at entity {} failed, nothing in it was '
+                  'minted: {}'.format(minted_count + 1, e.error_summary),
+                  file=sys.stderr)
+            sys.exit(1)
+        writer.writerows(minted)
+        minted_count += len(minted)
+    print('Minted {} URIs'.format(minted_count), file=sys.stderr)
+    return minted_count
+
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
 from logging import getLogger
-from flask import Blueprint, redirect
+from flask import Blueprint, Response, redirect, make_response, send_file, stream_with_context
 
 from ckan.logic import ValidationError
 from ckan.plugins import toolkit as tk
@@ -8,7 +11,10 @@ from ckan.common import _, g, request
 from ckan.lib import base
 from ckan import authz
 import ckan.lib.helpers as h
-from ckanext.dia.model import MintedURI
+from ckanext.dia.dump import get_dump_path, read_dump_meta
+from ckanext.dia.export import EXPORT_FORMATS, iter_export
+from ckanext.dia.model import MintedURI, build_uri
+from ckanext.dia.pagination import KeysetPage, decode_cursor
 
 log = getLogger(__name__)
 
@@ -63,35 +69,67 @@ def new_uri():
 
 @uri_minter.route('/uri/', methods=['GET'])
 def list():
-    page_number = h.get_page_number(request.params)
     q = request.params.get(u'q', u'')
 
     data_dict = {
         u'q': q,
     }
 
-    uri_list = MintedURI.get_list(data_dict)
-
-    page = h.Page(
-        collection=uri_list,
-        page=page_number,
-        url=h.pager_url,
-        item_count=uri_list.count(),
-        items_per_page=10)
+    if q:
+        # Search results are ranked by relevance, so they are paged by
+        # offset rather than by position in the register
+        page_number = h.get_page_number(request.params)
+        uri_list = MintedURI.get_list(data_dict)
+
+        page = h.Page(
+            collection=uri_list,
+            page=page_number,
+            url=h.pager_url,
+            item_count=uri_list.count(),
+            items_per_page=10)
+    else:
+        after = decode_cursor(request.params.get(u'after'))
+        before = decode_cursor(request.params.get(u'before'))
+        items, more = MintedURI.get_keyset_page(
+            data_dict, limit=10, after=after, before=before)
+
+        page = KeysetPage(
+            items, more,
+            url_for=lambda **kw: h.url_for(u'uri_minter.list', **kw),
+            after=after,
+            before=before)
 
     extra_vars = {u'page': page, u'q': q}
     return tk.render(u'uris/list.html', extra_vars)
 
+
+@uri_minter.route('/uri/export', methods=['GET'])
+def export():
+    output_format = request.params.get(u'format', u'csv')
+    if output_format not in EXPORT_FORMATS:
+        base.abort(400, _(u'Unknown export format'))
+    content_type, extension = EXPORT_FORMATS[output_format]
+
+    # The register is streamed straight from the database cursor, so the
+    # request context has to outlive the view function
+    response = Response(
+        stream_with_context(iter_export(output_format)),
+        mimetype=content_type)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename="minted-uris.{}"'.format(extension)
+    return response
+
 @uri_minter.route('/uri/<int:uri_id>/', methods=['GET', 'POST'])
 def edit_uri(uri_id):
     current_uri = MintedURI.get(uri_id)
     if not current_uri:
         base.abort(404, 'URI not found')
     if current_uri.superseded_by != None:
-        base.aport(422, 'URI is archived, editing not supported')
+        base.abort(422, 'URI is archived, editing not supported')
 
     data = {'type': current_uri.type, 'name': current_uri.name}
-    vars = {'data': data, 'errors': None, 'error_summary': None, 'update': True}
+    vars = {'data': data, 'errors': None, 'error_summary': None, 'update': True,
+            'history': MintedURI.history(uri_id)}
     if request.method == 'POST':
         data_dict = dict(request.form)
         data_dict['type'] = current_uri.type
@@ -121,3 +159,81 @@ def edit_uri(uri_id):
             vars['error_summary'] = { 'Error': _('An unknown error occurred') }
 
     return tk.render('uris/edit.html', extra_vars=vars)
+
+
+uri_resolver = Blueprint("uri_resolver", __name__, template_folder='templates')
+
+RESOLVER_MIMETYPES = {
+    u'html': u'text/html',
+    u'json': u'application/json',
+    u'jsonld': u'application/ld+json',
+}
+
+
+@uri_resolver.route('/id/<type>/<guid>', methods=['GET'])
+def resolve_uri(type, guid):
+    resolved = MintedURI.resolve(build_uri(type, guid))
+    if resolved is None:
+        base.abort(404, _(u'URI not found'))
+
+    # ?format= wins over the Accept header
+    mimetype = RESOLVER_MIMETYPES.get(request.args.get(u'format')) or \
+        request.accept_mimetypes.best_match(
+            [u'text/html', u'application/json', u'application/ld+json'],
+            default=u'text/html')
+
+    etag = hashlib.sha1(json.dumps(
+        [mimetype, resolved], sort_keys=True).encode(u'utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response(u'', 304)
+    elif mimetype == u'application/json':
+        response = make_response(json.dumps(resolved))
+    elif mimetype == u'application/ld+json':
+        response = make_response(json.dumps(_resolved_uri_jsonld(resolved)))
+    else:
+        response = make_response(
+            tk.render(u'uris/resolve.html', extra_vars={u'uri': resolved}))
+
+    if response.status_code != 304:
+        response.mimetype = mimetype
+    response.set_etag(etag)
+    response.vary.add(u'Accept')
+    response.headers[u'Cache-Control'] = u'public, max-age={}'.format(
+        tk.asint(tk.config.get(u'ckanext.dia.uri_resolver.max_age', 300)))
+    return response
+
+
+@uri_resolver.route('/id/uris.nt', methods=['GET'])
+def uri_dump():
+    path = get_dump_path()
+    meta = read_dump_meta(path) if path else None
+    if meta is None:
+        base.abort(404, _(u'URI dump not found'))
+
+    if request.if_none_match.contains(meta[u'etag']):
+        response = make_response(u'', 304)
+    else:
+        response = send_file(
+            os.path.abspath(path), mimetype=u'application/n-triples')
+    response.set_etag(meta[u'etag'])
+    response.headers[u'Cache-Control'] = u'public, max-age={}'.format(
+        tk.asint(tk.config.get(u'ckanext.dia.uri_resolver.max_age', 300)))
+    return response
+
+
+def _resolved_uri_jsonld(resolved):
+    document = {
+        u'@context': {
+            u'dct': u'http://purl.org/dc/terms/',
+            u'rdfs': u'http://www.w3.org/2000/01/rdf-schema#',
+        },
+        u'@id': resolved[u'uri'],
+        u'rdfs:label': resolved[u'name'],
+        u'dct:type': resolved[u'type'],
+    }
+    if resolved[u'created_at']:
+        document[u'dct:created'] = resolved[u'created_at']
+    if resolved[u'superseded']:
+        document[u'dct:isReplacedBy'] = {u'@id': resolved[u'current_uri']}
+    return document
+